@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+
+import argparse
+import contextlib
+import gzip
+import os
+import sqlite3
+
+import rapidjson as json
+
+from read import read_all_fit_results
+
+# An index of the results under intermediary_data/ by their provenance,
+# as written by describe_inputs: every scalar key of a result's description
+# can be used to select it without opening any result files.
+
+root_name = "intermediary_data"
+catalog_name = "catalog.sqlite"
+
+schema = """
+CREATE TABLE IF NOT EXISTS results (
+    filename TEXT PRIMARY KEY,
+    stage TEXT NOT NULL,
+    description TEXT,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS keys (
+    filename TEXT NOT NULL REFERENCES results (filename) ON DELETE CASCADE,
+    key TEXT NOT NULL,
+    value,
+    PRIMARY KEY (filename, key)
+);
+CREATE INDEX IF NOT EXISTS keys_by_value ON keys (key, value);
+CREATE INDEX IF NOT EXISTS results_by_stage ON results (stage);
+"""
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="Index intermediary results by their provenance, and query them"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    scan_parser = subparsers.add_parser(
+        "scan", help="Bring the catalog up to date with the files on disk"
+    )
+    scan_parser.add_argument("root", nargs="?", default=root_name)
+
+    query_parser = subparsers.add_parser(
+        "query", help="List the results matching all of the given criteria"
+    )
+    query_parser.add_argument("root", nargs="?", default=root_name)
+    query_parser.add_argument("--stage", default=None)
+    query_parser.add_argument(
+        "--where",
+        nargs="+",
+        default=[],
+        metavar="KEY=VALUE",
+        help="e.g. operator=sym time=3.5, or time=3.5:6 for a range",
+    )
+    query_parser.add_argument(
+        "--values",
+        default=None,
+        metavar="KEY",
+        help="List the distinct values of KEY among the matches instead",
+    )
+    return parser.parse_args()
+
+
+def add_argument(parser):
+    parser.add_argument(
+        "--catalog",
+        action="store_true",
+        help=(
+            f"Record the output in {root_name}/{catalog_name}; "
+            "this locks the catalog, so is best avoided with many concurrent jobs "
+            "or on a shared filesystem, where `catalog.py scan` can be run instead"
+        ),
+    )
+
+
+def find_root(filename):
+    # The intermediary_data directory holding filename, if any
+    directory = os.path.dirname(os.path.abspath(filename))
+    while os.path.basename(directory) != root_name:
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return None
+        directory = parent
+    return directory
+
+
+@contextlib.contextmanager
+def _transaction(root):
+    # Many jobs may register results at once; each waits its turn
+    connection = sqlite3.connect(
+        os.path.join(root, catalog_name), timeout=600, isolation_level=None
+    )
+    try:
+        connection.execute("PRAGMA foreign_keys = ON")
+        connection.executescript(schema)
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+    finally:
+        connection.close()
+
+
+def _flatten(description, prefix=""):
+    # Scalar keys only; per-ensemble data_sources are not indexed
+    for key, value in description.items():
+        if key.startswith("_"):
+            continue
+        if isinstance(value, dict):
+            yield from _flatten(value, f"{prefix}{key}.")
+        elif isinstance(value, (bool, int, float, str)):
+            yield prefix + key, value
+
+
+def read_description(filename):
+    with gzip.open(filename, "r") as f:
+        return json.load(f)["description"].get("description") or {}
+
+
+def _insert(connection, root, filename, description):
+    relative_filename = os.path.relpath(os.path.abspath(filename), root)
+    status = os.stat(filename)
+    connection.execute(
+        "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+        (
+            relative_filename,
+            relative_filename.split(os.sep)[0],
+            description.get("_description"),
+            status.st_mtime,
+            status.st_size,
+        ),
+    )
+    connection.execute("DELETE FROM keys WHERE filename = ?", (relative_filename,))
+    connection.executemany(
+        "INSERT INTO keys VALUES (?, ?, ?)",
+        [(relative_filename, key, value) for key, value in _flatten(description)],
+    )
+
+
+def register(filename, description=None):
+    # Called by each stage run with --catalog once it has written filename;
+    # results outside intermediary_data, and hidden partial outputs, are skipped
+    root = find_root(filename)
+    if root is None:
+        return
+    relative_filename = os.path.relpath(os.path.abspath(filename), root)
+    if any(part.startswith(".") for part in relative_filename.split(os.sep)):
+        return
+    if os.path.isdir(filename):
+        for directory, _, filenames in os.walk(filename):
+            for name in sorted(filenames):
+                if name.endswith(".json.gz"):
+                    register(os.path.join(directory, name))
+        return
+
+    if description is None:
+        description = read_description(filename)
+    with _transaction(root) as connection:
+        _insert(connection, root, filename, description)
+
+
+def scan(root=root_name):
+    # Index files that are new or changed since they were registered,
+    # and forget those that have gone; returns the numbers of each
+    on_disk = {}
+    for directory, subdirectories, filenames in os.walk(root):
+        subdirectories[:] = [
+            name for name in subdirectories if not name.startswith(".")
+        ]
+        for name in filenames:
+            if name.endswith(".json.gz") and not name.startswith("."):
+                filename = os.path.join(directory, name)
+                status = os.stat(filename)
+                on_disk[os.path.relpath(filename, root)] = (
+                    status.st_mtime,
+                    status.st_size,
+                )
+
+    with _transaction(os.path.abspath(root)) as connection:
+        catalogued = {
+            filename: (mtime, size)
+            for filename, mtime, size in connection.execute(
+                "SELECT filename, mtime, size FROM results"
+            )
+        }
+        removed = catalogued.keys() - on_disk.keys()
+        connection.executemany(
+            "DELETE FROM results WHERE filename = ?",
+            [(filename,) for filename in removed],
+        )
+        changed = [
+            filename
+            for filename, status in on_disk.items()
+            if catalogued.get(filename) != status
+        ]
+        for filename in changed:
+            full_filename = os.path.join(root, filename)
+            _insert(
+                connection,
+                os.path.abspath(root),
+                full_filename,
+                read_description(full_filename),
+            )
+
+    return len(changed), len(removed)
+
+
+def _select(root, stage, criteria, columns, column_parameters=()):
+    catalog_filename = os.path.join(root, catalog_name)
+    if not os.path.exists(catalog_filename):
+        return []
+
+    conditions, parameters = [], list(column_parameters)
+    if stage is not None:
+        conditions.append("results.stage = ?")
+        parameters.append(stage)
+    for key, value in criteria.items():
+        if isinstance(value, tuple):
+            # Inclusive range
+            conditions.append(
+                "results.filename IN (SELECT filename FROM keys "
+                "WHERE key = ? AND value BETWEEN ? AND ?)"
+            )
+            parameters.extend([key, *value])
+        else:
+            conditions.append(
+                "results.filename IN (SELECT filename FROM keys "
+                "WHERE key = ? AND value = ?)"
+            )
+            parameters.extend([key, value])
+
+    query = f"SELECT {columns} FROM results"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    with contextlib.closing(
+        sqlite3.connect(catalog_filename, timeout=600)
+    ) as connection:
+        return connection.execute(query, parameters).fetchall()
+
+
+def find(root=root_name, stage=None, **criteria):
+    # Filenames of the results in the given stage (the subdirectory of root)
+    # whose descriptions match every criterion: key=value for equality,
+    # or key=(low, high) for an inclusive range
+    return [
+        os.path.join(root, filename)
+        for (filename,) in sorted(_select(root, stage, criteria, "filename"))
+        if os.path.exists(os.path.join(root, filename))
+    ]
+
+
+def load(root=root_name, stage=None, pyerrors=True, **criteria):
+    return read_all_fit_results(find(root, stage, **criteria), pyerrors=pyerrors)
+
+
+def values(key, root=root_name, stage=None, **criteria):
+    # Distinct values of key among the matching results
+    rows = _select(
+        root,
+        stage,
+        criteria,
+        "DISTINCT (SELECT value FROM keys "
+        "WHERE keys.filename = results.filename AND keys.key = ?)",
+        column_parameters=[key],
+    )
+    return sorted(value for (value,) in rows if value is not None)
+
+
+def parse_criterion(criterion):
+    key, value = criterion.split("=", 1)
+    if ":" in value:
+        return key, tuple(map(parse_value, value.split(":", 1)))
+    return key, parse_value(value)
+
+
+def parse_value(value):
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def main():
+    args = get_args()
+    if args.command == "scan":
+        changed, removed = scan(args.root)
+        print(f"Indexed {changed} results; forgot {removed}.")
+    elif args.values:
+        criteria = dict(map(parse_criterion, args.where))
+        for value in values(args.values, args.root, args.stage, **criteria):
+            print(value)
+    else:
+        criteria = dict(map(parse_criterion, args.where))
+        for filename in find(args.root, args.stage, **criteria):
+            print(filename)
+
+
+if __name__ == "__main__":
+    main()
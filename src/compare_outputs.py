@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+
+import argparse
+import collections
+import concurrent.futures
+import gzip
+import os
+import sys
+import tempfile
+
+import numpy as np
+import pyerrors as pe
+import rapidjson as json
+
+import pipeline
+import read
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description=(
+            "Check that two sets of intermediary data agree: "
+            "every Obs value, error and correlation, and every plain number, "
+            "is compared within the given tolerances."
+        )
+    )
+    parser.add_argument("reference_directory")
+    parser.add_argument("candidate_directory")
+    parser.add_argument(
+        "--run",
+        action="store_true",
+        help=(
+            "First run the pipeline twice, writing into the two directories, "
+            "with the reference and candidate configuration overrides"
+        ),
+    )
+    parser.add_argument("--config_file", default="workflow/config.yaml")
+    parser.add_argument("--reference_config", nargs="+", default=[])
+    parser.add_argument("--candidate_config", nargs="+", default=[])
+    parser.add_argument("--cores", type=int, default=1)
+    parser.add_argument(
+        "--value_tolerance",
+        type=float,
+        default=1e-2,
+        help="Largest allowed shift of a central value, in units of its error",
+    )
+    parser.add_argument(
+        "--error_tolerance",
+        type=float,
+        default=1e-2,
+        help="Largest allowed relative change of an error",
+    )
+    parser.add_argument(
+        "--correlation_tolerance",
+        type=float,
+        default=1e-2,
+        help="Largest allowed change of a correlation coefficient",
+    )
+    parser.add_argument(
+        "--rtol",
+        type=float,
+        default=1e-6,
+        help="Relative tolerance for numbers without an error",
+    )
+    parser.add_argument("--verbose", action="store_true")
+    return parser.parse_args()
+
+
+def find_outputs(directory):
+    return sorted(
+        os.path.relpath(os.path.join(root, filename), directory)
+        for root, _, filenames in os.walk(directory)
+        for filename in filenames
+        if filename.endswith(".json.gz")
+    )
+
+
+def load_output(filename):
+    # Files with no Obs in them (e.g. fixed points) can't be read by pyerrors
+    with gzip.open(filename, "r") as f:
+        raw = json.load(f)
+    if not raw["obsdata"]:
+        return raw["description"]["OBSDICT"]
+    return pe.input.json.load_json_dict(filename, verbose=False)
+
+
+def flatten(obj, path=()):
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            yield from flatten(value, path + (str(key),))
+    elif isinstance(obj, pe.Corr):
+        for index, element in enumerate(obj.content):
+            if element is not None:
+                yield from flatten(element, path + (str(index),))
+    elif isinstance(obj, (list, tuple, np.ndarray)):
+        for index, value in enumerate(obj):
+            yield from flatten(value, path + (str(index),))
+    elif isinstance(obj, (pe.Obs, int, float, np.number)) and not isinstance(obj, bool):
+        yield "/".join(path), obj
+
+
+def _value_drift(reference, candidate, error):
+    difference = abs(candidate - reference)
+    if error > 0:
+        return difference / error
+    return 0.0 if difference == 0 else np.inf
+
+
+def _relative_drift(reference, candidate):
+    difference = abs(candidate - reference)
+    if reference != 0:
+        return difference / abs(reference)
+    return 0.0 if difference == 0 else np.inf
+
+
+def _correlation(obs):
+    errors = np.asarray([element.dvalue for element in obs])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        correlation = pe.covariance(obs) / np.outer(errors, errors)
+    return np.nan_to_num(correlation)
+
+
+def compare_files(reference_filename, candidate_filename):
+    # The worst drift of each kind found between two output files,
+    # and the element responsible for it
+    reference = dict(flatten(load_output(reference_filename)))
+    candidate = dict(flatten(load_output(candidate_filename)))
+    mismatched = sorted(reference.keys() ^ candidate.keys())
+    worst = {}
+
+    def record(kind, drift, path):
+        if kind not in worst or drift > worst[kind][0]:
+            worst[kind] = (drift, path)
+
+    obs_paths = []
+    for path in sorted(reference.keys() & candidate.keys()):
+        old, new = reference[path], candidate[path]
+        name = path.split("/")[-1]
+        if isinstance(old, pe.Obs) != isinstance(new, pe.Obs):
+            mismatched.append(path)
+        elif isinstance(old, pe.Obs):
+            old.gamma_method()
+            new.gamma_method()
+            record("values", _value_drift(old.value, new.value, old.dvalue), path)
+            record("errors", _relative_drift(old.dvalue, new.dvalue), path)
+            obs_paths.append(path)
+        elif name.startswith("value_"):
+            # Results stored as plain numbers with a separate uncertainty,
+            # as fit_fixed_point writes them
+            uncertainty = reference.get(path.replace("value_", "uncertainty_"), 0)
+            record("values", _value_drift(old, new, uncertainty), path)
+        elif name.startswith("uncertainty_"):
+            record("errors", _relative_drift(old, new), path)
+        else:
+            record("numbers", _relative_drift(old, new), path)
+
+    if len(obs_paths) > 1:
+        difference = np.abs(
+            _correlation([candidate[path] for path in obs_paths])
+            - _correlation([reference[path] for path in obs_paths])
+        )
+        row, column = np.unravel_index(np.argmax(difference), difference.shape)
+        record(
+            "correlations",
+            difference[row, column],
+            f"{obs_paths[row]} x {obs_paths[column]}",
+        )
+
+    return mismatched, worst
+
+
+def compare_directories(reference_directory, candidate_directory, tolerances):
+    # stage -> [(output filename, problems)], where problems is empty
+    # when the file agrees within the tolerances
+    reference_outputs = find_outputs(reference_directory)
+    candidate_outputs = find_outputs(candidate_directory)
+
+    report = collections.defaultdict(list)
+    for filename in sorted(set(reference_outputs) | set(candidate_outputs)):
+        if filename not in candidate_outputs:
+            problems = ["missing from candidate"]
+        elif filename not in reference_outputs:
+            problems = ["missing from reference"]
+        else:
+            mismatched, worst = compare_files(
+                os.path.join(reference_directory, filename),
+                os.path.join(candidate_directory, filename),
+            )
+            problems = [f"structure differs at {path}" for path in mismatched] + [
+                f"{kind} drift {drift:.3g} at {path}"
+                for kind, (drift, path) in worst.items()
+                if not drift <= tolerances[kind]
+            ]
+        report[os.path.dirname(filename)].append((filename, problems))
+    return report
+
+
+def run_pipeline(config_file, overrides, output_directory, cores=1):
+    config = pipeline.load_config(config_file, overrides)
+    # Each run ingests the data afresh into its own cache, as the shared one
+    # may hold results ingested by other code, which joblib doesn't notice,
+    # or with other ingestion workers, which it ignores
+    with tempfile.TemporaryDirectory() as cache_directory:
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=cores,
+            initializer=read.use_cache,
+            initargs=(cache_directory,),
+        ) as executor:
+            pipeline.run(
+                config, executor, output_directory=output_directory, plots=False
+            )
+
+
+def main():
+    args = get_args()
+    if args.run:
+        for directory, overrides in [
+            (args.reference_directory, args.reference_config),
+            (args.candidate_directory, args.candidate_config),
+        ]:
+            run_pipeline(args.config_file, overrides, directory, cores=args.cores)
+
+    report = compare_directories(
+        args.reference_directory,
+        args.candidate_directory,
+        {
+            "values": args.value_tolerance,
+            "errors": args.error_tolerance,
+            "correlations": args.correlation_tolerance,
+            "numbers": args.rtol,
+        },
+    )
+
+    drifted = False
+    for stage, results in sorted(report.items()):
+        num_drifted = sum(bool(problems) for _, problems in results)
+        drifted = drifted or num_drifted > 0
+        print(f"{stage}: {num_drifted} of {len(results)} files drifted")
+        for filename, problems in results:
+            if problems:
+                print(f"  DRIFT {filename}")
+                for problem in problems:
+                    print(f"    {problem}")
+            elif args.verbose:
+                print(f"  OK    {filename}")
+
+    if drifted:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
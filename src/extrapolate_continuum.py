@@ -2,12 +2,17 @@
 
 import argparse
 
+import numpy as np
 import pyerrors as pe
 
-from extrapolate_infinite_volume import linear_fit
-from fit_beta_against_g2 import interpolating_form
+import catalog
+import resampling
+from extrapolate_infinite_volume import linear_fit, linear_fit_map
+from fit_beta_against_g2 import interpolating_form, select_order
+from precision import rounded
 from provenance import describe_inputs
 from read import read_all_fit_results
+from utils import interpolation_order
 
 
 def get_args():
@@ -15,10 +20,26 @@ def get_args():
     parser.add_argument("input_filenames", metavar="input_filename", nargs="+")
     parser.add_argument("--g_squared", type=float, required=True)
     parser.add_argument("--output_filename", default=None)
+    parser.add_argument(
+        "--interpolation_order",
+        default=None,
+        type=interpolation_order,
+        help=(
+            "Use this order (or 'average') of interpolations fit with several "
+            "orders, rather than the one they pass on by default"
+        ),
+    )
+    parser.add_argument(
+        "--reduced_precision",
+        action="store_true",
+        help="Write deltas rounded to 8 significant digits; see precision.py",
+    )
+    resampling.add_arguments(parser)
+    catalog.add_argument(parser)
     return parser.parse_args()
 
 
-def get_metadata(data, g_squared):
+def get_metadata(data, g_squared, interpolation_order=None, resampler=None):
     description = "Continuum limit of beta function at fixed coupling."
     specific_keys = ["filename", "time"]
     consistent_keys = ["Nc", "operator"]
@@ -30,31 +51,85 @@ def get_metadata(data, g_squared):
         g_squared=g_squared,
         min_time=min(datum["time"] for datum in data),
         max_time=max(datum["time"] for datum in data),
+        **(
+            {}
+            if interpolation_order is None
+            else {"interpolation_order": interpolation_order}
+        ),
+        **({} if resampler is None else {"resampling": resampler.describe()}),
     )
 
 
-def fit(data, g_squared):
+def fit(data, g_squared, interpolation_order=None, resampler=None):
+    if resampler is not None:
+        parameters = resample_interpolations(data, resampler, interpolation_order)
+        return list(fit_resampled(data, parameters, g_squared).to_obs())
+
     x_values = [1 / datum["time"] for datum in data]
-    beta_values = [
-        interpolating_form(datum["beta_interpolation"], g_squared, datum["order"])
-        for datum in data
-    ]
+    beta_values = []
+    for datum in data:
+        parameters, order = select_order(datum, interpolation_order)
+        beta_values.append(interpolating_form(parameters, g_squared, order))
     for beta in beta_values:
         beta.gamma_method()
     result = pe.fits.least_squares(x_values, beta_values, linear_fit, silent=True)
     return result.fit_parameters
 
 
+def resample_interpolations(data, resampler, interpolation_order=None):
+    # Samples of each datum's interpolation parameters,
+    # padded with zeros to the highest order among them
+    selected = [select_order(datum, interpolation_order) for datum in data]
+    max_order = max(order for _, order in selected)
+    return resampler.resample(
+        [
+            list(parameters) + [0.0] * (max_order - order)
+            for parameters, order in selected
+        ]
+    )
+
+
+def fit_resampled(data, parameters, g_squared):
+    # As fit, for parameters from resample_interpolations, which may be
+    # reused for each g_squared
+    beta = parameters.derived(
+        interpolating_form(
+            np.moveaxis(parameters.values, -1, 0),
+            g_squared,
+            parameters.values.shape[-1],
+        )
+    )
+    # Weighted by the gamma method errors, as in fit
+    errors = []
+    for value in beta.to_obs():
+        value.gamma_method()
+        errors.append(value.dvalue)
+    fit_map, _ = linear_fit_map(
+        [1 / datum["time"] for datum in data], errors, beta.central
+    )
+    return beta.derived(beta.values @ fit_map.T)
+
+
 def main():
     args = get_args()
     data = read_all_fit_results(args.input_filenames)
-    result = fit(data, args.g_squared)
+    resampler = resampling.from_args(args)
+    result = fit(data, args.g_squared, args.interpolation_order, resampler)
     if args.output_filename:
+        metadata = get_metadata(
+            data, args.g_squared, args.interpolation_order, resampler
+        )
         pe.input.json.dump_dict_to_json(
-            {"continuum_extrapolation": result},
+            {
+                "continuum_extrapolation": rounded(result)
+                if args.reduced_precision
+                else result
+            },
             args.output_filename,
-            description=get_metadata(data, args.g_squared),
+            description=metadata,
         )
+        if args.catalog:
+            catalog.register(args.output_filename, metadata)
     else:
         for param in result:
             param.gamma_method()
@@ -1,13 +1,21 @@
 #!/usr/bin/env python3
 
 import argparse
+import contextlib
 
+import numpy as np
 import pyerrors as pe
 
+import catalog
+import resampling
+from precision import rounded
 from provenance import describe_inputs, get_consistent_metadata
 from read import get_all_flows
+from shared_flows import shared_all_flows
 from stats import weighted_mean
-from utils import zip_combinations
+from utils import bin_size, zip_combinations
+
+scales = ["gGF^2", "betaGF"]
 
 
 def get_args():
@@ -15,8 +23,71 @@ def get_args():
     parser.add_argument("flow_filenames", metavar="flow_filename", nargs="+")
     parser.add_argument("--reader", default="hp")
     parser.add_argument("--operator", default="sym")
-    parser.add_argument("--output_filename", default=None)
-    parser.add_argument("--time", required=True, type=float)
+    parser.add_argument(
+        "--output_filename",
+        nargs="+",
+        default=None,
+        help="One filename for each --time, in the same order",
+    )
+    parser.add_argument("--time", required=True, type=float, nargs="+")
+    parser.add_argument(
+        "--bin_size",
+        default=None,
+        type=bin_size,
+        help="Bin configurations before analysis; 'auto' bins to twice tau_int",
+    )
+    parser.add_argument(
+        "--shared_memory",
+        action="store_true",
+        help="Share flow data with concurrent jobs on this node",
+    )
+    parser.add_argument(
+        "--shared_memory_directory",
+        default=None,
+        help=(
+            "Where jobs using --shared_memory record their use of the data, "
+            "common to all jobs on a node; "
+            "defaults to hp_pv_shared_flows in the temporary directory"
+        ),
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only parse configurations appended since the last incremental read",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes used to read ensembles in parallel",
+    )
+    parser.add_argument(
+        "--reduced_precision",
+        action="store_true",
+        help=(
+            "Cache and share flow data in single precision, "
+            "and write deltas rounded to 8 significant digits; see precision.py"
+        ),
+    )
+    parser.add_argument(
+        "--global_fit_times",
+        nargs=2,
+        type=float,
+        default=None,
+        metavar=("TMIN", "TMAX"),
+        help=(
+            "Fit all flow times in this range at once, "
+            "with the volume dependence a polynomial in the flow time"
+        ),
+    )
+    parser.add_argument(
+        "--global_fit_degree",
+        type=int,
+        default=3,
+        help="Degree of the polynomial in the flow time for --global_fit_times",
+    )
+    resampling.add_arguments(parser)
+    catalog.add_argument(parser)
     return parser.parse_args()
 
 
@@ -29,10 +100,24 @@ def get_scales_at_time(flows, scale, time):
     return result
 
 
+def get_finite_volumes(flows, time):
+    # The values fitted at each volume, in the order of data_sources,
+    # so that plots need not reread the flows;
+    # kept per ensemble, as pyerrors only writes lists of Obs on one ensemble
+    values = {scale: get_scales_at_time(flows, scale, time) for scale in scales}
+    return [
+        {scale: values[scale][index] for scale in scales} for index in range(len(flows))
+    ]
+
+
 def linear_fit(a, x):
     return a[0] + a[1] * x
 
 
+def linear_fit_jacobian(x):
+    return np.asarray([np.ones_like(x), x])
+
+
 def fit_single(x_values, y_values):
     result = pe.fits.least_squares(x_values, y_values, linear_fit, silent=True)
 
@@ -40,11 +125,13 @@ def fit_single(x_values, y_values):
     return result, result.chisquare_by_dof + 2 * len(result.fit_parameters)
 
 
-def fit_scale(flows, scale, time):
+def fit_scale(flows, scale, time, resampler=None):
     x_values = [1 / flow["NX"] ** 4 for flow in flows]
     scale_values = get_scales_at_time(flows, scale, time)
     for value in scale_values:
         value.gamma_method()
+    if resampler is not None:
+        return fit_scale_resampled(x_values, scale_values, resampler)
     fit_results = [
         fit_single(x_subset, scale_subset)
         for x_subset, scale_subset in zip_combinations(
@@ -54,9 +141,155 @@ def fit_scale(flows, scale, time):
     return weighted_mean(fit_results)
 
 
-def get_metadata(flows, operator, time):
+def linear_fit_map(x_values, errors, y_values):
+    # fit_single as a fixed matrix M giving the fit parameters as M @ y,
+    # and the AIC of the fit to y_values
+    return global_fit_map(
+        np.asarray(x_values),
+        np.asarray(errors)[:, np.newaxis],
+        np.asarray(y_values)[:, np.newaxis],
+        smooth_basis(1, 0),
+        list(range(len(x_values))),
+    )
+
+
+def fit_scale_resampled(x_values, scale_values, resampler):
+    # As fit_scale, with each fit applied to every sample at once
+    samples = resampler.resample(scale_values)
+    errors = np.asarray([value.dvalue for value in scale_values])
+    maps, aics = [], []
+    for (volume_indices,) in zip_combinations(range(len(x_values)), min_count=3):
+        fit_map, aic = linear_fit_map(
+            np.asarray(x_values)[volume_indices],
+            errors[volume_indices],
+            samples.central[volume_indices],
+        )
+        full_map = np.zeros((len(fit_map), len(x_values)))
+        full_map[:, volume_indices] = fit_map
+        maps.append(full_map)
+        aics.append(aic)
+
+    # As weighted_mean
+    weights = np.exp(-(np.asarray(aics) - min(aics)))
+    combined_map = np.tensordot(weights / weights.sum(), maps, axes=1)
+    result = list(samples.derived(samples.values @ combined_map.T).to_obs())
+    for value in result:
+        value.gamma_method()
+    return result
+
+
+def get_time_indices(flows, tmin, tmax):
+    h = get_consistent_metadata(flows, "h")
+    return h, list(range(int(tmin / h), int(tmax / h) + 1))
+
+
+def smooth_basis(num_times, degree):
+    # Polynomials in the flow time, rescaled to [-1, 1] for conditioning
+    degree = min(degree, num_times - 1)
+    return np.vander(np.linspace(-1, 1, num_times), degree + 1, increasing=True)
+
+
+def global_fit_map(x_values, errors, y_values, basis, volume_indices):
+    # Uncorrelated least squares fit of
+    #     scale(t, L) = a(t) + b(t) / L^4,
+    # with a free intercept a(t) at each time and b(t) = sum_k c_k basis_k(t),
+    # to the volumes selected by volume_indices.
+    # Being linear, the fit parameters are M @ y for a fixed matrix M
+    num_times = len(basis)
+    design = np.vstack(
+        [
+            np.hstack([np.eye(num_times), x_values[volume] * basis])
+            for volume in volume_indices
+        ]
+    )
+    weights = 1 / errors[volume_indices].ravel() ** 2
+    weighted_design = design.T * weights
+    fit_map = np.linalg.solve(weighted_design @ design, weighted_design)
+
+    y_subset = y_values[volume_indices].ravel()
+    residuals = y_subset - design @ (fit_map @ y_subset)
+    chisquare_by_dof = (weights * residuals**2).sum() / (
+        len(y_subset) - design.shape[1]
+    )
+
+    # Eq. (7) of 2402.18038 to compute AIC weight
+    return fit_map, chisquare_by_dof + 2 * design.shape[1]
+
+
+def fit_scale_global(flows, scale, times, tmin, tmax, degree, resampler=None):
+    # All flow times in [tmin, tmax] are fit at once, so that the volume
+    # dependence varies smoothly with time and correlations between times
+    # are kept; gives the same [intercept, slope] per time as fit_scale
+    h, time_indices = get_time_indices(flows, tmin, tmax)
+    positions = []
+    for time in times:
+        if int(time / h) not in time_indices:
+            raise ValueError(f"Time {time} is outside the global fit range.")
+        positions.append(time_indices.index(int(time / h)))
+
+    data = np.asarray(
+        [[flow[scale][index] for index in time_indices] for flow in flows]
+    )
+    if any(value is None for value in data.ravel()):
+        raise ValueError(f"{scale} is not defined throughout the global fit range.")
+    for value in data.ravel():
+        value.gamma_method()
+    x_values = np.asarray([1 / flow["NX"] ** 4 for flow in flows])
+    y_values = np.vectorize(lambda value: value.value)(data)
+    errors = np.vectorize(lambda value: value.dvalue)(data)
+    basis = smooth_basis(len(time_indices), degree)
+
+    # Rows of the per-time output (intercept, then slope, for each time)
+    # in terms of the fit parameters
+    num_times = len(time_indices)
+    output_map = np.zeros((2 * len(times), num_times + basis.shape[1]))
+    for row, position in enumerate(positions):
+        output_map[2 * row, position] = 1
+        output_map[2 * row + 1, num_times:] = basis[position]
+
+    maps, aics = [], []
+    for (volume_indices,) in zip_combinations(range(len(flows)), min_count=3):
+        fit_map, aic = global_fit_map(x_values, errors, y_values, basis, volume_indices)
+        full_map = np.zeros((len(output_map), data.size))
+        for column, volume in enumerate(volume_indices):
+            full_map[:, volume * num_times : (volume + 1) * num_times] = (
+                output_map @ fit_map[:, column * num_times : (column + 1) * num_times]
+            )
+        maps.append(full_map)
+        aics.append(aic)
+
+    # As weighted_mean, but with weights relative to the best fit,
+    # since the many parameters make exp(-aic) underflow
+    weights = np.exp(-(np.asarray(aics) - min(aics)))
+    combined_map = np.tensordot(weights / weights.sum(), maps, axes=1)
+
+    if resampler is None:
+        # array_mode contracts the last two axes of each element of its data
+        result = pe.derived_observable(
+            lambda x, **kwargs: combined_map @ x[0, 0],
+            data.reshape(1, 1, -1),
+            array_mode=True,
+            man_grad=combined_map[:, np.newaxis, np.newaxis, :],
+        )
+    else:
+        samples = resampler.resample(data.ravel())
+        result = samples.derived(samples.values @ combined_map.T).to_obs()
+    for value in result:
+        value.gamma_method()
+    return {time: list(result[2 * row : 2 * row + 2]) for row, time in enumerate(times)}
+
+
+def get_metadata(flows, operator, time, global_fit=None, resampler=None):
     description = "Infinite volume extrapolation for gradient flow data."
-    ensemble_keys = ["filename", "NX", "NY", "NZ", "NT"]
+    ensemble_keys = [
+        "filename",
+        "NX",
+        "NY",
+        "NZ",
+        "NT",
+        "num_configurations",
+        "bin_size",
+    ]
     consistent_keys = ["beta", "Nc"]
     return describe_inputs(
         flows,
@@ -65,34 +298,87 @@ def get_metadata(flows, operator, time):
         consistent_keys,
         operator=operator,
         time=time,
+        **({} if global_fit is None else {"global_fit": global_fit}),
+        **({} if resampler is None else {"resampling": resampler.describe()}),
     )
 
 
 def main():
     args = get_args()
-    flows = get_all_flows(
-        args.flow_filenames,
-        reader=args.reader,
-        operator=args.operator,
-        extra_metadata={"Nc": 3},
-    )
+    flow_args = {
+        "reader": args.reader,
+        "operator": args.operator,
+        "extra_metadata": {"Nc": 3},
+        "bin_size": args.bin_size,
+        "incremental": args.incremental,
+        "workers": args.workers,
+        "reduced_precision": args.reduced_precision,
+    }
+    if args.shared_memory:
+        flows_context = shared_all_flows(
+            args.flow_filenames,
+            registry_directory=args.shared_memory_directory,
+            **flow_args,
+        )
+    else:
+        flows_context = contextlib.nullcontext(
+            get_all_flows(args.flow_filenames, **flow_args)
+        )
 
-    # Ensure a single consistent beta will be fit
-    get_consistent_metadata(flows, "beta")
+    if args.output_filename and len(args.output_filename) != len(args.time):
+        raise ValueError("An output filename is needed for each time.")
+    resampler = resampling.from_args(args)
 
-    result = {
-        scale: fit_scale(flows, scale, args.time) for scale in ["gGF^2", "betaGF"]
-    }
+    # Times may be repeated, spelled differently in their output filenames
+    times = sorted(set(args.time))
+    with flows_context as flows:
+        # Ensure a single consistent beta will be fit
+        get_consistent_metadata(flows, "beta")
+
+        if args.global_fit_times:
+            global_fit = {
+                "tmin": args.global_fit_times[0],
+                "tmax": args.global_fit_times[1],
+                "degree": args.global_fit_degree,
+            }
+            # One fit per scale for all times
+            fits = {
+                scale: fit_scale_global(
+                    flows, scale, times, **global_fit, resampler=resampler
+                )
+                for scale in scales
+            }
+            results = {
+                time: {scale: fits[scale][time] for scale in scales} for time in times
+            }
+        else:
+            global_fit = None
+            results = {
+                time: {
+                    scale: fit_scale(flows, scale, time, resampler) for scale in scales
+                }
+                for time in times
+            }
+        metadata = {}
+        for time, result in results.items():
+            result["finite_volume"] = get_finite_volumes(flows, time)
+            metadata[time] = get_metadata(
+                flows, args.operator, time, global_fit, resampler
+            )
 
     if args.output_filename:
-        pe.input.json.dump_dict_to_json(
-            result,
-            args.output_filename,
-            description=get_metadata(flows, args.operator, args.time),
-        )
+        for time, output_filename in zip(args.time, args.output_filename):
+            pe.input.json.dump_dict_to_json(
+                rounded(results[time]) if args.reduced_precision else results[time],
+                output_filename,
+                description=metadata[time],
+            )
+            if args.catalog:
+                catalog.register(output_filename, metadata[time])
     else:
-        for observable, value in result.items():
-            print(f"{observable}: {value}")
+        for time, result in results.items():
+            for observable, value in result.items():
+                print(f"{observable} at t={time}: {value}")
 
 
 if __name__ == "__main__":
@@ -3,8 +3,11 @@
 import argparse
 import functools
 
+import numpy as np
 import pyerrors as pe
 
+import catalog
+from precision import rounded
 from provenance import describe_inputs
 from read import read_all_fit_results
 
@@ -13,7 +16,28 @@ def get_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("input_filenames", metavar="input_filename", nargs="+")
     parser.add_argument("--order", type=int, default=4)
+    parser.add_argument(
+        "--orders",
+        type=int,
+        nargs="+",
+        default=[],
+        help=(
+            "Further orders to fit alongside --order, "
+            "stored with their AIC for later stages to select from"
+        ),
+    )
+    parser.add_argument(
+        "--average",
+        action="store_true",
+        help="Pass on the AIC-weighted average over all orders, not just --order",
+    )
     parser.add_argument("--output_filename", default=None)
+    parser.add_argument(
+        "--reduced_precision",
+        action="store_true",
+        help="Write deltas rounded to 8 significant digits; see precision.py",
+    )
+    catalog.add_argument(parser)
     return parser.parse_args()
 
 
@@ -22,29 +46,115 @@ def interpolating_form(a, x, n=4):
     return x**2 * sum([a[i] * x**i for i in range(n)])
 
 
-def fit_single(data, order=4):
+def interpolating_form_jacobian(x, n=4):
+    return np.asarray([x ** (i + 2) for i in range(n)])
+
+
+def fit_result(data, order=4, initial_guess=None):
     result = pe.fits.total_least_squares(
         [datum["gGF^2"][0] for datum in data],
         [datum["betaGF"][0] for datum in data],
         functools.partial(interpolating_form, n=order),
         silent=True,
+        **({} if initial_guess is None else {"initial_guess": initial_guess}),
     )
     for value in result.fit_parameters:
         value.gamma_method()
 
-    return result.fit_parameters
+    return result
+
+
+def fit_single(data, order=4):
+    return fit_result(data, order=order).fit_parameters
+
+
+def get_aic(result):
+    # Eq. (7) of 2402.18038, as for the infinite volume extrapolation;
+    # a fit with no degrees of freedom can't be compared with others
+    if result.dof <= 0:
+        return np.inf
+    return result.odr_chisquare / result.dof + 2 * len(result.fit_parameters)
+
+
+def fit_orders(data, orders):
+    # order -> (parameters, AIC), from one read of the data;
+    # each order starts from the parameters of the one below
+    fits = {}
+    initial_guess = None
+    for order in sorted(orders):
+        if initial_guess is not None:
+            initial_guess = initial_guess + [0.0] * (order - len(initial_guess))
+        result = fit_result(data, order=order, initial_guess=initial_guess)
+        fits[order] = result.fit_parameters, get_aic(result)
+        initial_guess = [float(value) for value in result.fit_parameters]
+    return fits
+
+
+def average_orders(fits):
+    # The AIC-weighted average of the interpolating forms is itself one
+    # of the highest order, with the missing parameters of lower orders zero
+    aics = np.asarray([aic for _, aic in fits.values()])
+    if not np.isfinite(aics).any():
+        raise ValueError("No order has any degrees of freedom to compare.")
+    weights = np.exp(-(aics - aics.min()))
+    weights /= weights.sum()
+
+    result = [
+        sum(
+            weight * parameters[index]
+            for (parameters, _), weight in zip(fits.values(), weights)
+            if index < len(parameters)
+        )
+        for index in range(max(fits))
+    ]
+    for value in result:
+        value.gamma_method()
+    return result
+
+
+def get_output(fits, order, average=False):
+    # With several orders, all of them (and their average) are kept,
+    # and the one selected is also given as beta_interpolation
+    if len(fits) == 1:
+        return {"beta_interpolation": fits[order][0]}
+    orders = {str(fit_order): parameters for fit_order, (parameters, _) in fits.items()}
+    orders["average"] = average_orders(fits)
+    return {
+        "beta_interpolation": orders["average" if average else str(order)],
+        "beta_interpolation_orders": orders,
+    }
+
+
+def select_order(datum, order=None):
+    # The parameters and order of an interpolation result to use:
+    # those of beta_interpolation by default,
+    # or one of several orders fit at once, or "average"
+    if order is None:
+        return datum["beta_interpolation"], datum["order"]
+    parameters = datum["beta_interpolation_orders"][str(order)]
+    return parameters, len(parameters)
 
 
-def get_metadata(data, order):
+def get_metadata(data, order, fits=None, average=False):
     description = "Interpolating form for beta function at finite lattice spacing."
     specific_keys = ["filename", "beta"]
     consistent_keys = ["time", "Nc", "operator"]
+    extra = {}
+    if fits is not None and len(fits) > 1:
+        if average:
+            order = max(fits)
+        extra = {
+            "orders": sorted(fits),
+            "aic": {str(fit_order): aic for fit_order, (_, aic) in fits.items()},
+            "averaged": average,
+        }
     return describe_inputs(
         data,
         description,
         specific_keys,
         consistent_keys,
         order=order,
+        **extra,
     )
 
 
@@ -54,15 +164,27 @@ def main():
     for datum in data:
         for key in "gGF^2", "betaGF":
             datum[key][0].gamma_method()
-    result = fit_single(data, order=args.order)
+    fits = fit_orders(data, set(args.orders) | {args.order})
+    result = get_output(fits, args.order, average=args.average)
     if args.output_filename:
+        metadata = get_metadata(data, args.order, fits, average=args.average)
         pe.input.json.dump_dict_to_json(
-            {"beta_interpolation": result},
+            rounded(result) if args.reduced_precision else result,
             args.output_filename,
-            description=get_metadata(data, args.order),
+            description=metadata,
         )
+        if args.catalog:
+            catalog.register(args.output_filename, metadata)
     else:
-        print(f"beta(g^2) interpolation: {result}")
+        for order, (parameters, aic) in fits.items():
+            print(
+                f"beta(g^2) interpolation, order {order} (AIC {aic:.2f}): {parameters}"
+            )
+        if len(fits) > 1:
+            print(
+                "AIC-weighted average: "
+                f"{result['beta_interpolation_orders']['average']}"
+            )
 
 
 if __name__ == "__main__":
@@ -2,10 +2,13 @@
 
 import argparse
 
+import numpy as np
 import pyerrors as pe
 import scipy.interpolate
 import uncertainties
 
+import catalog
+import resampling
 from provenance import describe_inputs
 from read import read_all_fit_results
 
@@ -14,6 +17,8 @@ def get_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("input_filenames", metavar="input_filename", nargs="+")
     parser.add_argument("--output_filename", default=None)
+    resampling.add_arguments(parser)
+    catalog.add_argument(parser)
     return parser.parse_args()
 
 
@@ -45,11 +50,62 @@ def fit_single(g_squared, beta):
     return g_star_squared, 2 * spline(g_star_squared, nu=1)
 
 
+def fit_columns(g_squared, beta, iterations=60):
+    # fit_single for each column of beta at once. The interpolant is
+    # monotonic between knots, so a root lies in each interval over which
+    # beta changes sign, and is found there by bisection
+    spline = scipy.interpolate.PchipInterpolator(g_squared, beta, axis=0)
+    crossings = (beta[:-1] < 0) != (beta[1:] < 0)
+    num_roots = crossings.sum(axis=0)
+    if (num_roots != 1).any():
+        raise ValueError(
+            f"Obtained {sorted(set(num_roots[num_roots != 1]))} roots "
+            f"in {(num_roots != 1).sum()} of {len(num_roots)} samples."
+        )
+
+    columns = np.arange(beta.shape[1])
+    interval = crossings.argmax(axis=0)
+    # Coefficients of the cubic in each root's interval, highest power first
+    coefficients = spline.c[:, interval, columns]
+    lower = np.zeros(len(columns))
+    upper = spline.x[interval + 1] - spline.x[interval]
+    lower_sign = np.sign(np.polyval(coefficients, lower))
+    for _ in range(iterations):
+        middle = (lower + upper) / 2
+        same_sign = np.sign(np.polyval(coefficients, middle)) == lower_sign
+        lower = np.where(same_sign, middle, lower)
+        upper = np.where(same_sign, upper, middle)
+    root = (lower + upper) / 2
+    slope = np.polyval(coefficients[:-1] * [[3], [2], [1]], root)
+
+    # Eq. (11) of 2402.18038
+    return spline.x[interval] + root, 2 * slope
+
+
+def fit_resampled(g_squared, beta):
+    # For samples of the continuum beta function at each of g_squared
+    g_star_squared, gamma_star = fit_columns(g_squared, beta.values.T)
+    result = beta.derived(np.stack([g_star_squared, gamma_star], axis=1)).to_obs()
+    return tuple(get_ufloat_obs(value) for value in result)
+
+
+def get_ufloat_obs(value):
+    value.gamma_method()
+    return uncertainties.ufloat(value.value, value.dvalue)
+
+
 def get_ufloat(centre, upper, lower):
     return uncertainties.ufloat(centre, abs(upper - lower) / 2)
 
 
-def fit(data):
+def fit(data, resampler=None):
+    if resampler is not None:
+        data = sorted(data, key=lambda datum: datum["g_squared"])
+        return fit_resampled(
+            [datum["g_squared"] for datum in data],
+            resampler.resample([datum["continuum_extrapolation"][0] for datum in data]),
+        )
+
     g_squared, beta_centre, beta_upper, beta_lower = get_g_squared_beta(data)
     g_star_2_centre, gamma_star_centre = fit_single(g_squared, beta_centre)
     g_star_2_upper, gamma_star_upper = fit_single(g_squared, beta_upper)
@@ -61,30 +117,44 @@ def fit(data):
     return g_star_squared, gamma_star
 
 
-def get_metadata(data):
+def get_metadata(data, resampler=None):
     description = "Estimate of fixed point and anomalous dimension at fixed point."
     specific_keys = ["filename", "g_squared"]
     consistent_keys = ["min_time", "max_time", "operator"]
-    return describe_inputs(data, description, specific_keys, consistent_keys)
+    return describe_inputs(
+        data,
+        description,
+        specific_keys,
+        consistent_keys,
+        **({} if resampler is None else {"resampling": resampler.describe()}),
+    )
+
+
+def get_output(g_star_squared, gamma_star):
+    return {
+        "value_g_star_squared": g_star_squared.nominal_value,
+        "value_gamma_star": gamma_star.nominal_value,
+        "uncertainty_g_star_squared": g_star_squared.std_dev,
+        "uncertainty_gamma_star": gamma_star.std_dev,
+    }
 
 
 def main():
     args = get_args()
     data = read_all_fit_results(args.input_filenames)
-    g_star_squared, gamma_star = fit(data)
+    resampler = resampling.from_args(args)
+    g_star_squared, gamma_star = fit(data, resampler)
     for datum in data:
         datum["continuum_extrapolation"][0].gamma_method()
     if args.output_filename:
+        metadata = get_metadata(data, resampler)
         pe.input.json.dump_dict_to_json(
-            {
-                "value_g_star_squared": g_star_squared.nominal_value,
-                "value_gamma_star": gamma_star.nominal_value,
-                "uncertainty_g_star_squared": g_star_squared.std_dev,
-                "uncertainty_gamma_star": gamma_star.std_dev,
-            },
+            get_output(g_star_squared, gamma_star),
             args.output_filename,
-            description=get_metadata(data),
+            description=metadata,
         )
+        if args.catalog:
+            catalog.register(args.output_filename, metadata)
     else:
         print(f"g_{{GF*}}^2 interpolation: {g_star_squared}")
         print(f"gamma*: {gamma_star}")
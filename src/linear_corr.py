@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import pyerrors as pe
+import scipy.sparse
+
+# Offsets and weights of the finite differences used by pe.Corr.deriv
+stencils = {
+    "symmetric": ([-1, 1], [-0.5, 0.5]),
+    "improved": ([-2, -1, 1, 2], [1 / 12, -8 / 12, 8 / 12, -1 / 12]),
+}
+
+
+class FlowSamples:
+    # Monte Carlo history of one observable at every flow time of an ensemble,
+    # laid out as in an Obs but with a row per flow time:
+    # deltas[name] has shape (num_times, num_configurations),
+    # r_values[name] has shape (num_times,)
+
+    def __init__(self, deltas, r_values, names, idl):
+        self.deltas = deltas
+        self.r_values = r_values
+        self.names = names
+        self.idl = idl
+
+
+class LinearCorr:
+    # Read-only stand-in for a flow Corr whose elements are fixed linear
+    # combinations of the rows of a FlowSamples, which any LinearCorr
+    # derived from it shares rather than copying.
+    # Indexing builds an Obs for that flow time only.
+
+    def __init__(self, samples, weights, present):
+        self.samples = samples
+        self.weights = scipy.sparse.csr_matrix(weights)
+        self.present = np.asarray(present, dtype=bool)
+
+    @classmethod
+    def from_corr(cls, corr):
+        elements = [corr[index] for index in range(len(corr.content))]
+        present = [element is not None for element in elements]
+        template = next(element for element in elements if element is not None)
+        names = list(template.names)
+        num_times = len(elements)
+
+        deltas, r_values = {}, {}
+        for name in names:
+            deltas[name] = np.zeros((num_times, len(template.deltas[name])))
+            r_values[name] = np.zeros(num_times)
+            for index, element in enumerate(elements):
+                if element is not None:
+                    deltas[name][index] = element.deltas[name]
+                    r_values[name][index] = element.r_values[name]
+
+        return cls(
+            FlowSamples(
+                deltas, r_values, names, [template.idl[name] for name in names]
+            ),
+            scipy.sparse.diags(np.asarray(present, dtype=float)),
+            present,
+        )
+
+    def __len__(self):
+        return len(self.present)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not self.present[index]:
+            return None
+        row = slice(self.weights.indptr[index], self.weights.indptr[index + 1])
+        rows, coefficients = self.weights.indices[row], self.weights.data[row]
+        return pe.Obs(
+            [
+                # Deltas may be held in single precision; work in double
+                coefficients @ self.samples.deltas[name][rows].astype(float)
+                + coefficients @ self.samples.r_values[name][rows]
+                for name in self.samples.names
+            ],
+            self.samples.names,
+            idl=self.samples.idl,
+        )
+
+    def _derived(self, transform, present=None):
+        return LinearCorr(
+            self.samples,
+            transform @ self.weights,
+            self.present if present is None else present,
+        )
+
+    def scaled(self, factors):
+        # Multiply each flow time by its own factor
+        return self._derived(scipy.sparse.diags(np.asarray(factors, dtype=float)))
+
+    def __mul__(self, factor):
+        return self._derived(scipy.sparse.identity(len(self)) * factor)
+
+    __rmul__ = __mul__
+
+    def __truediv__(self, divisor):
+        return self * (1 / divisor)
+
+    def __neg__(self):
+        return self * -1
+
+    def deriv(self, variant="symmetric"):
+        offsets, coefficients = stencils[variant]
+        num_times = len(self)
+        padding = max(abs(offset) for offset in offsets)
+        present = np.zeros(num_times, dtype=bool)
+        stencil = scipy.sparse.lil_matrix((num_times, num_times))
+        for time in range(padding, num_times - padding):
+            if all(self.present[time + offset] for offset in offsets):
+                present[time] = True
+                for offset, coefficient in zip(offsets, coefficients):
+                    stencil[time, time + offset] = coefficient
+        if not present.any():
+            raise ValueError("Derivative is undefined at all flow times")
+        return self._derived(stencil.tocsr(), present)
+
+    def release(self):
+        self.samples.deltas = None
@@ -0,0 +1,666 @@
+#!/usr/bin/env python3
+
+import argparse
+import collections
+import concurrent.futures
+import os
+
+import numpy as np
+import pyerrors as pe
+import yaml
+
+import catalog
+import extrapolate_continuum
+import extrapolate_infinite_volume
+import fit_beta_against_g2
+import fit_fixed_point
+import plot_beta_against_g2
+import plot_beta_against_g2_continuum
+import plot_continuum_extrapolation
+import plot_fixed_point_scan
+import plot_infinite_volume_extrapolation
+import resampling
+import scan_continuum
+from plots import save_or_show, use_styles
+from precision import rounded
+from provenance import get_consistent_metadata
+from read import get_all_flows, read_all_fit_results
+
+plot_styles = "styles/paperdraft.mplstyle"
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description=(
+            "Run the analysis of workflow/Snakefile in a single process tree, "
+            "keeping intermediary results in memory."
+        )
+    )
+    parser.add_argument("--config_file", default="workflow/config.yaml")
+    parser.add_argument(
+        "--config",
+        nargs="+",
+        default=[],
+        metavar="KEY=VALUE",
+        help="Override configuration values, as for snakemake --config",
+    )
+    parser.add_argument("--cores", type=int, default=1)
+    parser.add_argument(
+        "--output_directory",
+        default=None,
+        help=(
+            "Write intermediary data and plots under this directory, "
+            "with the same names as the Snakemake workflow uses; "
+            "if omitted, nothing is written and plots are not drawn"
+        ),
+    )
+    return parser.parse_args()
+
+
+def load_config(filename, overrides=()):
+    with open(filename) as f:
+        config = yaml.safe_load(f)
+    for override in overrides:
+        key, value = override.split("=", 1)
+        config[key] = yaml.safe_load(value)
+    return config
+
+
+def continuum_times(tmin, tmax, dt):
+    # As continuum_extrapolation_sources in workflow/Snakefile
+    return [
+        f"{time:.02f}" for time in np.arange(float(tmin), float(tmax) + 0.01, float(dt))
+    ]
+
+
+def time_slug(tmin, tmax, dt):
+    return f"tmin{tmin}_tmax{tmax}_dt{dt}"
+
+
+def infinite_volume_name(beta_slug, time, operator):
+    return f"intermediary_data/infinite_volume/b{beta_slug}_t{time}_{operator}.json.gz"
+
+
+def interpolation_name(time, operator):
+    return f"intermediary_data/beta_interpolation/t{time}_{operator}.json.gz"
+
+
+def continuum_name(operator, g_squared, slug):
+    return (
+        "intermediary_data/continuum_extrapolation/"
+        f"{operator}_gsquared{g_squared}_{slug}.json.gz"
+    )
+
+
+def scan_name(operator, g_squareds, slug):
+    return (
+        "intermediary_data/continuum_scan/"
+        f"{operator}_gsquared{g_squareds[0]}-{g_squareds[-1]}_{slug}"
+    )
+
+
+def fixed_point_name(operator, slug):
+    return f"intermediary_data/fixed_point/{operator}_{slug}.json.gz"
+
+
+class Plan:
+    # The jobs needed for the outputs of `rule all`, with each distinct
+    # computation appearing once however many output files it feeds
+
+    def __init__(self, config):
+        operators = config["operators"]
+
+        # time slug -> (tmin, tmax, dt)
+        time_ranges = {}
+        fit_slug, unfit_slug = [
+            time_slug(**config[key])
+            for key in ["continuum_fit_times", "continuum_unfit_times"]
+        ]
+        for key, slug in [
+            ("continuum_fit_times", fit_slug),
+            ("continuum_unfit_times", unfit_slug),
+        ]:
+            time_ranges[slug] = tuple(
+                config[key][name] for name in ["tmin", "tmax", "dt"]
+            )
+        fixed_point_slugs = []
+        for tmin in config["fixed_point_scan_tmins"]:
+            for tmax in config["fixed_point_scan_tmaxes"]:
+                time_range = tmin, tmax, config["fixed_point_scan_dt"]
+                fixed_point_slugs.append(time_slug(*time_range))
+                time_ranges[fixed_point_slugs[-1]] = time_range
+
+        self.fixed_points = {
+            (operator, slug): [
+                str(g_squared)
+                for g_squared in np.linspace(**config["fixed_point_g_squareds"])
+            ]
+            for operator in operators
+            for slug in fixed_point_slugs
+        }
+
+        continuum_plot_g_squareds = list(
+            map(str, np.linspace(**config["continuum_plot_g_squareds"]))
+        )
+
+        # With adaptive_g_squared, the continuum beta function and the fixed
+        # points come from scans of a range of g^2, as in the Snakefile;
+        # (operator, time slug or "plot") -> (time slug, g^2 values)
+        self.scans = {}
+        if config.get("adaptive_g_squared", False):
+            for (operator, slug), g_squareds in self.fixed_points.items():
+                self.scans[operator, slug] = slug, g_squareds
+            for operator in operators:
+                self.scans[operator, "plot"] = fit_slug, continuum_plot_g_squareds
+
+        # (operator, time slug) -> g^2 values
+        self.continuum = collections.defaultdict(set)
+        for operator in operators:
+            plot_g_squareds = list(
+                map(str, config["continuum_extrapolation_plot_g_squareds"])
+            )
+            self.continuum[operator, fit_slug].update(plot_g_squareds)
+            self.continuum[operator, unfit_slug].update(plot_g_squareds)
+        if not self.scans:
+            for (operator, slug), g_squareds in self.fixed_points.items():
+                self.continuum[operator, slug].update(g_squareds)
+            for operator in operators:
+                self.continuum[operator, fit_slug].update(continuum_plot_g_squareds)
+
+        # (operator, time slug) -> time strings, as they appear in filenames
+        self.continuum_sources = {
+            (operator, slug): continuum_times(*time_ranges[slug])
+            for operator, slug in [
+                *self.continuum,
+                *((operator, slug) for (operator, _), (slug, _) in self.scans.items()),
+            ]
+        }
+
+        # (operator, float time) -> time strings
+        self.interpolations = collections.defaultdict(set)
+        for (operator, _), times in self.continuum_sources.items():
+            for time in times:
+                self.interpolations[operator, float(time)].add(time)
+        for operator in operators:
+            for time in map(str, config["finite_a_plot_times"]):
+                self.interpolations[operator, float(time)].add(time)
+
+        # (beta slug, operator) -> time strings
+        self.infinite_volume = collections.defaultdict(set)
+        for (operator, _), times in self.interpolations.items():
+            for beta_slug in config["beta_slugs"]:
+                self.infinite_volume[beta_slug, operator].update(times)
+        for operator in operators:
+            for beta_slug in config["volume_plot_beta_slugs"]:
+                self.infinite_volume[beta_slug, operator].update(
+                    map(str, config["volume_plot_times"])
+                )
+        if config.get("global_volume_fit", False):
+            # All times of each beta are then fit in one job,
+            # whose outputs the Snakefile can't vary between betas
+            all_times = set().union(*self.infinite_volume.values())
+            for key in self.infinite_volume:
+                self.infinite_volume[key] = set(all_times)
+
+
+def global_fit(config):
+    if not config.get("global_volume_fit", False):
+        return None
+    return {
+        "tmin": config["global_fit_times"]["tmin"],
+        "tmax": config["global_fit_times"]["tmax"],
+        "degree": config["global_fit_degree"],
+    }
+
+
+def _output(result, description, filename, output_directory, reduced_precision=False):
+    if reduced_precision:
+        # Pass on what Snakemake would read back from the file
+        result = rounded(result)
+    if output_directory is not None:
+        filename = os.path.normpath(os.path.join(output_directory, filename))
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        pe.input.json.dump_dict_to_json(result, filename, description=description)
+    return {**description, **result, "filename": filename}
+
+
+def infinite_volume_job(
+    data_filenames,
+    beta_slug,
+    operator,
+    times,
+    bin_size=None,
+    incremental=False,
+    workers=1,
+    reduced_precision=False,
+    global_fit=None,
+    resampler=None,
+    output_directory=None,
+):
+    flows = get_all_flows(
+        data_filenames,
+        operator=operator,
+        extra_metadata={"Nc": 3},
+        bin_size=bin_size,
+        incremental=incremental,
+        workers=workers,
+        reduced_precision=reduced_precision,
+    )
+    get_consistent_metadata(flows, "beta")
+
+    results, fits = {}, {}
+    if global_fit is not None:
+        # One fit per scale for all times
+        unique_times = sorted(set(map(float, times)))
+        global_fits = {
+            scale: extrapolate_infinite_volume.fit_scale_global(
+                flows, scale, unique_times, **global_fit, resampler=resampler
+            )
+            for scale in extrapolate_infinite_volume.scales
+        }
+        for time in unique_times:
+            fits[time] = {scale: global_fits[scale][time] for scale in global_fits}
+    for time in times:
+        if float(time) not in fits:
+            fits[float(time)] = {
+                scale: extrapolate_infinite_volume.fit_scale(
+                    flows, scale, float(time), resampler
+                )
+                for scale in extrapolate_infinite_volume.scales
+            }
+        results[time] = {
+            **fits[float(time)],
+            "finite_volume": extrapolate_infinite_volume.get_finite_volumes(
+                flows, float(time)
+            ),
+        }
+
+    return {
+        time: _output(
+            result,
+            extrapolate_infinite_volume.get_metadata(
+                flows,
+                operator,
+                float(time),
+                global_fit,
+                resampler,
+            ),
+            infinite_volume_name(beta_slug, time, operator),
+            output_directory,
+            reduced_precision,
+        )
+        for time, result in results.items()
+    }
+
+
+def interpolation_job(
+    data_by_time,
+    operator,
+    order,
+    orders=(),
+    average=False,
+    reduced_precision=False,
+    output_directory=None,
+):
+    # data_by_time maps time strings to their infinite volume results;
+    # all refer to the same flow time, so one fit serves them all
+    result = None
+    outputs = {}
+    for time, data in data_by_time.items():
+        if result is None:
+            for datum in data:
+                for key in "gGF^2", "betaGF":
+                    datum[key][0].gamma_method()
+            fits = fit_beta_against_g2.fit_orders(data, set(orders) | {order})
+            result = fit_beta_against_g2.get_output(fits, order, average=average)
+        outputs[time] = _output(
+            result,
+            fit_beta_against_g2.get_metadata(data, order, fits, average=average),
+            interpolation_name(time, operator),
+            output_directory,
+            reduced_precision,
+        )
+    return outputs
+
+
+def continuum_job(
+    data,
+    operator,
+    slug,
+    g_squareds,
+    interpolation_order=None,
+    resampler=None,
+    reduced_precision=False,
+    output_directory=None,
+):
+    if resampler is not None:
+        # Resampled once for all g_squareds
+        parameters = extrapolate_continuum.resample_interpolations(
+            data, resampler, interpolation_order
+        )
+    outputs = {}
+    for g_squared in g_squareds:
+        if resampler is None:
+            result = extrapolate_continuum.fit(
+                data, float(g_squared), interpolation_order
+            )
+        else:
+            result = list(
+                extrapolate_continuum.fit_resampled(
+                    data, parameters, float(g_squared)
+                ).to_obs()
+            )
+        for param in result:
+            param.gamma_method()
+        outputs[g_squared] = _output(
+            {"continuum_extrapolation": result},
+            extrapolate_continuum.get_metadata(
+                data, float(g_squared), interpolation_order, resampler
+            ),
+            continuum_name(operator, g_squared, slug),
+            output_directory,
+            reduced_precision,
+        )
+    return outputs
+
+
+def scan_job(
+    data,
+    operator,
+    slug,
+    g_squareds,
+    interpolation_order=None,
+    resampler=None,
+    reduced_precision=False,
+    output_directory=None,
+):
+    points, _ = scan_continuum.scan(
+        data,
+        float(g_squareds[0]),
+        float(g_squareds[-1]),
+        interpolation_order=interpolation_order,
+        resampler=resampler,
+    )
+    directory = scan_name(operator, g_squareds, slug)
+    outputs = [
+        _output(
+            {"continuum_extrapolation": point["continuum_extrapolation"]},
+            {
+                key: value
+                for key, value in point.items()
+                if key not in ("continuum_extrapolation", "samples")
+            },
+            os.path.join(directory, f"gsquared{point['g_squared']}.json.gz"),
+            output_directory,
+            reduced_precision,
+        )
+        for point in points
+    ]
+    # In the order the Snakefile passes them on
+    return sorted(outputs, key=lambda output: output["filename"])
+
+
+def fixed_point_job(data, operator, slug, resampler=None, output_directory=None):
+    g_star_squared, gamma_star = fit_fixed_point.fit(data, resampler)
+    return _output(
+        fit_fixed_point.get_output(g_star_squared, gamma_star),
+        fit_fixed_point.get_metadata(data, resampler),
+        fixed_point_name(operator, slug),
+        output_directory,
+    )
+
+
+def plot_job(plot, plot_filename, inputs, draft_style=False, pyerrors=True, **kwargs):
+    use_styles(plot_styles, draft=draft_style)
+    os.makedirs(os.path.dirname(plot_filename), exist_ok=True)
+    data = [read_all_fit_results(filenames, pyerrors=pyerrors) for filenames in inputs]
+    save_or_show(plot(*data, **kwargs), plot_filename)
+
+
+def run_all(executor, function, jobs):
+    futures = {key: executor.submit(function, **kwargs) for key, kwargs in jobs.items()}
+    return {key: future.result() for key, future in futures.items()}
+
+
+def run(config, executor, output_directory=None, plots=True):
+    plan = Plan(config)
+
+    infinite_volume = {}
+    for (beta_slug, operator), outputs in run_all(
+        executor,
+        infinite_volume_job,
+        {
+            (beta_slug, operator): {
+                "data_filenames": [
+                    f"data/l{NX}t{NX}b{beta_slug}{config['data_suffix']}"
+                    for NX in config["lattice_sizes"]
+                ],
+                "beta_slug": beta_slug,
+                "operator": operator,
+                "times": sorted(times),
+                "bin_size": config.get("bin_size"),
+                "incremental": config.get("incremental", False),
+                "workers": config.get("ingest_workers", 1),
+                "reduced_precision": config.get("reduced_precision", False),
+                "global_fit": global_fit(config),
+                "resampler": resampling.from_config(config),
+                "output_directory": output_directory,
+            }
+            for (beta_slug, operator), times in plan.infinite_volume.items()
+        },
+    ).items():
+        for time, output in outputs.items():
+            infinite_volume[beta_slug, time, operator] = output
+
+    interpolations = {}
+    for (operator, _), outputs in run_all(
+        executor,
+        interpolation_job,
+        {
+            (operator, time): {
+                "data_by_time": {
+                    time_string: [
+                        infinite_volume[beta_slug, time_string, operator]
+                        for beta_slug in config["beta_slugs"]
+                    ]
+                    for time_string in sorted(time_strings)
+                },
+                "operator": operator,
+                "order": config["interpolate_fit_order"],
+                "orders": config["interpolate_fit_orders"],
+                "average": config["interpolate_fit_average"],
+                "reduced_precision": config.get("reduced_precision", False),
+                "output_directory": output_directory,
+            }
+            for (operator, time), time_strings in plan.interpolations.items()
+        },
+    ).items():
+        for time, output in outputs.items():
+            interpolations[time, operator] = output
+
+    continuum = {}
+    for (operator, slug), outputs in run_all(
+        executor,
+        continuum_job,
+        {
+            (operator, slug): {
+                "data": [
+                    interpolations[time, operator]
+                    for time in plan.continuum_sources[operator, slug]
+                ],
+                "operator": operator,
+                "slug": slug,
+                "g_squareds": sorted(g_squareds, key=float),
+                "interpolation_order": config["continuum_interpolation_order"],
+                "resampler": resampling.from_config(config),
+                "reduced_precision": config.get("reduced_precision", False),
+                "output_directory": output_directory,
+            }
+            for (operator, slug), g_squareds in plan.continuum.items()
+        },
+    ).items():
+        for g_squared, output in outputs.items():
+            continuum[operator, g_squared, slug] = output
+
+    scans = run_all(
+        executor,
+        scan_job,
+        {
+            key: {
+                "data": [
+                    interpolations[time, key[0]]
+                    for time in plan.continuum_sources[key[0], slug]
+                ],
+                "operator": key[0],
+                "slug": slug,
+                "g_squareds": g_squareds,
+                "interpolation_order": config["continuum_interpolation_order"],
+                "resampler": resampling.from_config(config),
+                "reduced_precision": config.get("reduced_precision", False),
+                "output_directory": output_directory,
+            }
+            for key, (slug, g_squareds) in plan.scans.items()
+        },
+    )
+
+    fixed_points = run_all(
+        executor,
+        fixed_point_job,
+        {
+            (operator, slug): {
+                "data": scans[operator, slug]
+                if plan.scans
+                else [continuum[operator, g_squared, slug] for g_squared in g_squareds],
+                "operator": operator,
+                "slug": slug,
+                "resampler": resampling.from_config(config),
+                "output_directory": output_directory,
+            }
+            for (operator, slug), g_squareds in plan.fixed_points.items()
+        },
+    )
+
+    if output_directory is not None and config.get("catalog", False):
+        # Once, from this process, rather than by every job
+        catalog.scan(os.path.join(output_directory, catalog.root_name))
+
+    if output_directory is not None and plots:
+        run_all(
+            executor, plot_job, get_plot_jobs(config, plan, scans, output_directory)
+        )
+
+    return fixed_points
+
+
+def get_plot_jobs(config, plan, scans, output_directory):
+    def path(filename):
+        return os.path.normpath(os.path.join(output_directory, filename))
+
+    draft = config.get("draft", False)
+    extension = "png" if draft else "pdf"
+    fit_slug = time_slug(**config["continuum_fit_times"])
+    unfit_slug = time_slug(**config["continuum_unfit_times"])
+    plot_g_squareds = list(map(str, config["continuum_extrapolation_plot_g_squareds"]))
+    operators = config["operators"]
+
+    jobs = {}
+    for operator in operators:
+        jobs["volume", operator] = {
+            "plot": plot_infinite_volume_extrapolation.plot_g2_vs_L,
+            "plot_filename": path(
+                f"assets/plots/volume_extrapolation_{operator}.{extension}"
+            ),
+            "inputs": [
+                [
+                    path(infinite_volume_name(beta_slug, time, operator))
+                    for beta_slug in config["volume_plot_beta_slugs"]
+                    for time in map(str, config["volume_plot_times"])
+                ]
+            ],
+            "draft_style": draft,
+        }
+        jobs["finite_a", operator] = {
+            "plot": plot_beta_against_g2.plot,
+            "plot_filename": path(
+                f"assets/plots/beta_interpolation_finite_a_{operator}.{extension}"
+            ),
+            "inputs": [
+                [
+                    path(interpolation_name(time, operator))
+                    for time in map(str, config["finite_a_plot_times"])
+                ]
+            ],
+            "draft_style": draft,
+            "draft": draft,
+        }
+
+    jobs["continuum_extrapolation"] = {
+        "plot": plot_continuum_extrapolation.plot,
+        "plot_filename": path(f"assets/plots/continuum_extrapolation.{extension}"),
+        "inputs": [
+            [
+                path(continuum_name(operator, g_squared, slug))
+                for operator in operators
+                for g_squared in plot_g_squareds
+            ]
+            for slug in [fit_slug, unfit_slug]
+        ],
+        "draft_style": draft,
+        "tick_times": config["continuum_extrapolation_plot_tick_times"],
+    }
+
+    for plot_extension in [extension] if draft else [extension, "svg"]:
+        jobs["continuum_beta", plot_extension] = {
+            "plot": plot_beta_against_g2_continuum.plot,
+            "plot_filename": path(
+                f"assets/plots/continuum_betafunction.{plot_extension}"
+            ),
+            "inputs": [
+                # Already under output_directory
+                sorted(
+                    output["filename"]
+                    for operator in operators
+                    for output in scans[operator, "plot"]
+                )
+                if plan.scans
+                else [
+                    path(continuum_name(operator, g_squared, fit_slug))
+                    for operator in operators
+                    for g_squared in map(
+                        str, np.linspace(**config["continuum_plot_g_squareds"])
+                    )
+                ]
+            ],
+            "draft_style": draft,
+            "draft": draft,
+        }
+
+    jobs["fixed_point_scan"] = {
+        "plot": plot_fixed_point_scan.plot,
+        "plot_filename": path(f"assets/plots/fixed_point_scan.{extension}"),
+        "inputs": [[path(fixed_point_name(*key)) for key in plan.fixed_points]],
+        "draft_style": draft,
+        "pyerrors": False,
+    }
+    return jobs
+
+
+def main():
+    args = get_args()
+    config = load_config(args.config_file, args.config)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.cores) as executor:
+        fixed_points = run(config, executor, output_directory=args.output_directory)
+
+    if args.output_directory is None:
+        for (operator, slug), result in fixed_points.items():
+            print(
+                f"{operator} {slug}: "
+                f"g_{{GF*}}^2 = {result['value_g_star_squared']} "
+                f"+/- {result['uncertainty_g_star_squared']}, "
+                f"gamma* = {result['value_gamma_star']} "
+                f"+/- {result['uncertainty_gamma_star']}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,438 @@
+#!/usr/bin/env python3
+
+import argparse
+import collections
+import csv
+import glob
+import math
+import os
+from math import comb
+
+import numpy as np
+
+from pipeline import (
+    Plan,
+    continuum_name,
+    fixed_point_name,
+    infinite_volume_name,
+    interpolation_name,
+    load_config,
+    scan_name,
+    time_slug,
+)
+
+# Stages in the order Snakemake can run them;
+# each depends only on those before it
+rules = [
+    "extrapolate_infinite_volume",
+    "extrapolate_infinite_volume_global",
+    "interpolate_finite_a",
+    "extrapolate_continuum",
+    "scan_continuum",
+    "fit_fixed_point",
+    "plot_volume_extrapolation",
+    "plot_finite_a_interpolation",
+    "plot_continuum_extrapolation",
+    "plot_continuum_beta",
+    "plot_fixed_point_scan",
+]
+
+# computation identifies what a job works out, where several output files
+# hold the same result (e.g. for flow times spelled t3.5 and t3.50);
+# wildcards are those of the Snakefile rule's output, for the analysis stages;
+# outputs lists every file written by a job that writes several,
+# in which case output is the first of them
+Job = collections.namedtuple(
+    "Job",
+    ["rule", "output", "inputs", "fits", "computation", "wildcards", "outputs"],
+    defaults=[None, None, None],
+)
+
+
+def job_outputs(job):
+    return job.outputs or [job.output]
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description=(
+            "Estimate the cost of running workflow/Snakefile "
+            "with a given configuration, without running it."
+        )
+    )
+    parser.add_argument("--config_file", default="workflow/config.yaml")
+    parser.add_argument(
+        "--config",
+        nargs="+",
+        default=[],
+        metavar="KEY=VALUE",
+        help="Override configuration values, as for snakemake --config",
+    )
+    parser.add_argument("--cores", type=int, default=1)
+    parser.add_argument(
+        "--benchmark_directory",
+        default="benchmarks",
+        help="Where Snakemake has written benchmark files for previous runs",
+    )
+    parser.add_argument(
+        "--top",
+        type=int,
+        default=5,
+        help="Number of most frequently read files to list",
+    )
+    return parser.parse_args()
+
+
+def data_filenames(config, beta_slug):
+    return [
+        f"data/l{NX}t{NX}b{beta_slug}{config['data_suffix']}"
+        for NX in config["lattice_sizes"]
+    ]
+
+
+def volume_fits(num_volumes):
+    # fit_scale fits every subset of at least three volumes, for two scales
+    return 2 * sum(comb(num_volumes, count) for count in range(3, num_volumes + 1))
+
+
+def get_jobs(config):
+    # One Job per output file that `rule all` needs,
+    # mirroring the rules of workflow/Snakefile
+    plan = Plan(config)
+    operators = config["operators"]
+    adaptive = config.get("adaptive_g_squared", False)
+    extension = "png" if config.get("draft", False) else "pdf"
+    fit_slug = time_slug(**config["continuum_fit_times"])
+    unfit_slug = time_slug(**config["continuum_unfit_times"])
+    plot_g_squareds = list(map(str, config["continuum_extrapolation_plot_g_squareds"]))
+    continuum_plot_g_squareds = list(
+        map(str, np.linspace(**config["continuum_plot_g_squareds"]))
+    )
+    jobs = []
+
+    for (beta_slug, operator), times in plan.infinite_volume.items():
+        if config.get("global_volume_fit", False):
+            # One fit of all times, written to the same files
+            times = sorted(times, key=lambda time: (float(time), time))
+            outputs = [
+                infinite_volume_name(beta_slug, time, operator) for time in times
+            ]
+            jobs.append(
+                Job(
+                    "extrapolate_infinite_volume_global",
+                    outputs[0],
+                    data_filenames(config, beta_slug),
+                    volume_fits(len(config["lattice_sizes"])),
+                    (beta_slug, operator),
+                    {
+                        "beta_slug": beta_slug,
+                        "times": times,
+                        "operator": operator,
+                    },
+                    outputs,
+                )
+            )
+            continue
+        for time in sorted(times):
+            jobs.append(
+                Job(
+                    "extrapolate_infinite_volume",
+                    infinite_volume_name(beta_slug, time, operator),
+                    data_filenames(config, beta_slug),
+                    volume_fits(len(config["lattice_sizes"])),
+                    (beta_slug, operator, float(time)),
+                    {"beta_slug": beta_slug, "time": time, "operator": operator},
+                )
+            )
+
+    for (operator, _), times in plan.interpolations.items():
+        for time in sorted(times):
+            jobs.append(
+                Job(
+                    "interpolate_finite_a",
+                    interpolation_name(time, operator),
+                    [
+                        infinite_volume_name(beta_slug, time, operator)
+                        for beta_slug in config["beta_slugs"]
+                    ],
+                    len(
+                        set(config["interpolate_fit_orders"])
+                        | {config["interpolate_fit_order"]}
+                    ),
+                    (operator, float(time)),
+                    {"time": time, "operator": operator},
+                )
+            )
+
+    # (operator, time slug or "plot") -> output
+    scans = {
+        key: scan_name(key[0], g_squareds, slug)
+        for key, (slug, g_squareds) in plan.scans.items()
+    }
+
+    for (operator, slug), g_squareds in plan.continuum.items():
+        sources = [
+            interpolation_name(time, operator)
+            for time in plan.continuum_sources[operator, slug]
+        ]
+        for g_squared in sorted(set(g_squareds), key=float):
+            jobs.append(
+                Job(
+                    "extrapolate_continuum",
+                    continuum_name(operator, g_squared, slug),
+                    sources,
+                    1,
+                    wildcards={"operator": operator, "g_squared": g_squared},
+                )
+            )
+
+    for key, (slug, g_squareds) in plan.scans.items():
+        operator = key[0]
+        jobs.append(
+            Job(
+                "scan_continuum",
+                scans[key],
+                [
+                    interpolation_name(time, operator)
+                    for time in plan.continuum_sources[operator, slug]
+                ],
+                # A lower bound: the initial grid, before any refinement
+                9,
+                wildcards={
+                    "operator": operator,
+                    "g_squared_min": g_squareds[0],
+                    "g_squared_max": g_squareds[-1],
+                },
+            )
+        )
+
+    for (operator, slug), g_squareds in plan.fixed_points.items():
+        jobs.append(
+            Job(
+                "fit_fixed_point",
+                fixed_point_name(operator, slug),
+                [scans[operator, slug]]
+                if adaptive
+                else [
+                    continuum_name(operator, g_squared, slug)
+                    for g_squared in g_squareds
+                ],
+                3,
+                wildcards={"operator": operator},
+            )
+        )
+
+    for operator in operators:
+        jobs.append(
+            Job(
+                "plot_volume_extrapolation",
+                f"assets/plots/volume_extrapolation_{operator}.{extension}",
+                [
+                    infinite_volume_name(beta_slug, time, operator)
+                    for beta_slug in config["volume_plot_beta_slugs"]
+                    for time in config["volume_plot_times"]
+                ],
+                0,
+            )
+        )
+        jobs.append(
+            Job(
+                "plot_finite_a_interpolation",
+                f"assets/plots/beta_interpolation_finite_a_{operator}.{extension}",
+                [
+                    interpolation_name(time, operator)
+                    for time in config["finite_a_plot_times"]
+                ],
+                0,
+            )
+        )
+
+    jobs.append(
+        Job(
+            "plot_continuum_extrapolation",
+            f"assets/plots/continuum_extrapolation.{extension}",
+            [
+                continuum_name(operator, g_squared, slug)
+                for slug in [fit_slug, unfit_slug]
+                for operator in operators
+                for g_squared in plot_g_squareds
+            ],
+            0,
+        )
+    )
+    # Unless drafting, the continuum beta function is also drawn as SVG
+    for beta_extension in (
+        [extension] if config.get("draft", False) else [extension, "svg"]
+    ):
+        jobs.append(
+            Job(
+                "plot_continuum_beta",
+                f"assets/plots/continuum_betafunction.{beta_extension}",
+                [scans[operator, "plot"] for operator in operators]
+                if adaptive
+                else [
+                    continuum_name(operator, g_squared, fit_slug)
+                    for operator in operators
+                    for g_squared in continuum_plot_g_squareds
+                ],
+                0,
+            )
+        )
+    jobs.append(
+        Job(
+            "plot_fixed_point_scan",
+            f"assets/plots/fixed_point_scan.{extension}",
+            [fixed_point_name(*key) for key in plan.fixed_points],
+            0,
+        )
+    )
+    return jobs
+
+
+def read_benchmarks(benchmark_directory):
+    # rule -> (mean wall time in seconds, largest max_rss in MB, number of runs),
+    # from the files written by the `benchmark:` directives of workflow/Snakefile
+    benchmarks = {}
+    for rule in rules:
+        times, memories = [], []
+        for filename in glob.glob(os.path.join(benchmark_directory, rule, "*.tsv")):
+            with open(filename) as f:
+                for row in csv.DictReader(f, delimiter="\t"):
+                    times.append(float(row["s"]))
+                    try:
+                        memories.append(float(row["max_rss"]))
+                    except ValueError:
+                        # Not measured on every platform
+                        pass
+        if times:
+            benchmarks[rule] = (
+                np.mean(times),
+                max(memories) if memories else None,
+                len(times),
+            )
+    return benchmarks
+
+
+def format_time(seconds):
+    if seconds is None:
+        return "?"
+    minutes, seconds = divmod(round(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
+
+
+def format_memory(megabytes):
+    return "?" if megabytes is None else f"{megabytes / 1024:.2f} GB"
+
+
+def estimate(jobs, benchmarks, cores, threads):
+    # rule -> dict of counts and estimated costs,
+    # assuming each rule's jobs run after the previous rule's have finished
+    estimates = {}
+    for rule in rules:
+        rule_jobs = [job for job in jobs if job.rule == rule]
+        if not rule_jobs:
+            continue
+        concurrent = max(1, cores // threads.get(rule, 1))
+        mean_time, max_memory, _ = benchmarks.get(rule, (None, None, 0))
+        estimates[rule] = {
+            "jobs": len(rule_jobs),
+            "fits": sum(job.fits for job in rule_jobs),
+            "reads": sum(len(job.inputs) for job in rule_jobs),
+            "cpu_time": None if mean_time is None else mean_time * len(rule_jobs),
+            "wall_time": None
+            if mean_time is None
+            else mean_time * math.ceil(len(rule_jobs) / concurrent),
+            "memory": None
+            if max_memory is None
+            else max_memory * min(concurrent, len(rule_jobs)),
+        }
+    return estimates
+
+
+def duplicated_jobs(jobs):
+    # Snakemake runs a job per output file, so repeats these computations;
+    # src/pipeline.py does each only once
+    computations = collections.defaultdict(list)
+    for job in jobs:
+        computations[job.rule].append(job.computation or job.output)
+    return {rule: len(keys) - len(set(keys)) for rule, keys in computations.items()}
+
+
+def main():
+    args = get_args()
+    config = load_config(args.config_file, args.config)
+    jobs = get_jobs(config)
+    benchmarks = read_benchmarks(args.benchmark_directory)
+    ingest_workers = config.get("ingest_workers", 1)
+    estimates = estimate(
+        jobs,
+        benchmarks,
+        args.cores,
+        {
+            "extrapolate_infinite_volume": ingest_workers,
+            "extrapolate_infinite_volume_global": ingest_workers,
+        },
+    )
+
+    print(
+        f"{'rule':<36} {'jobs':>6} {'fits':>8} {'reads':>8} "
+        f"{'CPU time':>10} {'wall time':>10} {'peak memory':>12}"
+    )
+    for rule, rule_estimate in estimates.items():
+        print(
+            f"{rule:<36} {rule_estimate['jobs']:>6} {rule_estimate['fits']:>8} "
+            f"{rule_estimate['reads']:>8} "
+            f"{format_time(rule_estimate['cpu_time']):>10} "
+            f"{format_time(rule_estimate['wall_time']):>10} "
+            f"{format_memory(rule_estimate['memory']):>12}"
+        )
+
+    measured = [
+        rule_estimate
+        for rule_estimate in estimates.values()
+        if rule_estimate["cpu_time"] is not None
+    ]
+    total_fits = sum(rule_estimate["fits"] for rule_estimate in estimates.values())
+    total_reads = sum(len(job.inputs) for job in jobs)
+    total_cpu_time = total_wall_time = None
+    if measured:
+        total_cpu_time = sum(e["cpu_time"] for e in measured)
+        total_wall_time = sum(e["wall_time"] for e in measured)
+    peak_memory = max((e["memory"] or 0 for e in measured), default=None)
+    print(
+        f"{'total':<36} {len(jobs):>6} {total_fits:>8} {total_reads:>8} "
+        f"{format_time(total_cpu_time):>10} "
+        f"{format_time(total_wall_time):>10} "
+        f"{format_memory(peak_memory):>12}"
+    )
+    unmeasured = [rule for rule in estimates if rule not in benchmarks]
+    if unmeasured:
+        print(
+            f"\nNo benchmark files under {args.benchmark_directory} for "
+            f"{', '.join(unmeasured)}; their costs are excluded from the totals."
+        )
+    print(
+        "Times and memory are scaled up from the mean duration and largest "
+        f"memory use of previous runs of each rule, on {args.cores} cores."
+    )
+    if "scan_continuum" in estimates:
+        print("Fits for scan_continuum count only its initial grid.")
+
+    print("\nRedundant work:")
+    for rule, count in duplicated_jobs(jobs).items():
+        if count:
+            print(f"  {count} {rule} jobs repeat another's computation")
+    reads = collections.Counter(filename for job in jobs for filename in job.inputs)
+    print(
+        f"  {sum(reads.values())} file reads of {len(reads)} distinct files; "
+        f"{sum(count > 1 for count in reads.values())} files are read by "
+        "more than one job"
+    )
+    for filename, count in reads.most_common(args.top):
+        if count > 1:
+            print(f"    {count:>5} x {filename}")
+
+
+if __name__ == "__main__":
+    main()
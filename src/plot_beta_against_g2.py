@@ -1,13 +1,20 @@
 #!/usr/bin/env python3
 
 import argparse
+import functools
 
 import matplotlib.pyplot as plt
 import numpy as np
 import pyerrors as pe
 
-from fit_beta_against_g2 import interpolating_form
-from plots import PlotPropRegistry, errorbar_pyerrors, save_or_show
+from fit_beta_against_g2 import interpolating_form, interpolating_form_jacobian
+from plots import (
+    PlotPropRegistry,
+    error_band,
+    errorbar_pyerrors,
+    save_or_show,
+    use_styles,
+)
 from perturbation_theory import add_perturbative_lines
 from read import read_all_fit_results
 
@@ -17,6 +24,11 @@ def get_args():
     parser.add_argument("fit_filenames", nargs="+", metavar="beta_fit_filename")
     parser.add_argument("--plot_filename", default=None)
     parser.add_argument("--plot_styles", default="styles/paperdraft.mplstyle")
+    parser.add_argument(
+        "--draft",
+        action="store_true",
+        help="Render with mathtext at 150 dpi and skip the perturbative curves",
+    )
     return parser.parse_args()
 
 
@@ -30,14 +42,17 @@ def output_fits(fit_results, filename):
 
 def plot_fit(x_values, fit_result, ax, colour=None):
     scan_x = np.linspace(min(x_values), max(x_values), 1000)
-    scan_y = interpolating_form(np.asarray(fit_result, dtype=float), scan_x)
-    scan_errors = pe.fits.error_band(scan_x, interpolating_form, fit_result)
+    order = len(fit_result)
+    scan_y = interpolating_form(np.asarray(fit_result, dtype=float), scan_x, n=order)
+    scan_errors = error_band(
+        scan_x, functools.partial(interpolating_form_jacobian, n=order), fit_result
+    )
     ax.fill_between(
         scan_x, scan_y + scan_errors, scan_y - scan_errors, color=colour, alpha=0.2
     )
 
 
-def plot(fit_results):
+def plot(fit_results, draft=False):
     fig, ax = plt.subplots(layout="constrained", figsize=(3.5, 2.5))
     colours = PlotPropRegistry.colours()
 
@@ -67,7 +82,8 @@ def plot(fit_results):
         )
 
     _, xmax = ax.get_xlim()
-    add_perturbative_lines(ax, 0, xmax, "fun", 12, 3)
+    if not draft:
+        add_perturbative_lines(ax, 0, xmax, "fun", 12, 3)
 
     ax.set_xlim(0, xmax)
     ax.set_ylim(-2.4, 0.6)
@@ -78,9 +94,9 @@ def plot(fit_results):
 
 def main():
     args = get_args()
-    plt.style.use(args.plot_styles)
+    use_styles(args.plot_styles, draft=args.draft)
     fit_results = read_all_fit_results(args.fit_filenames)
-    save_or_show(plot(fit_results), args.plot_filename)
+    save_or_show(plot(fit_results, draft=args.draft), args.plot_filename)
 
 
 if __name__ == "__main__":
@@ -5,7 +5,7 @@ import argparse
 import matplotlib.pyplot as plt
 
 from names import operator_names
-from plots import save_or_show
+from plots import save_or_show, use_styles
 from perturbation_theory import add_perturbative_lines
 from read import read_all_fit_results
 
@@ -15,6 +15,11 @@ def get_args():
     parser.add_argument("fit_filenames", nargs="+", metavar="beta_continuum_filename")
     parser.add_argument("--plot_filename", default=None)
     parser.add_argument("--plot_styles", default="styles/paperdraft.mplstyle")
+    parser.add_argument(
+        "--draft",
+        action="store_true",
+        help="Render with mathtext at 150 dpi and skip the perturbative curves",
+    )
     return parser.parse_args()
 
 
@@ -29,7 +34,7 @@ def group_data(beta_continuum):
     }
 
 
-def plot(beta_continuum):
+def plot(beta_continuum, draft=False):
     fig, ax = plt.subplots(layout="constrained", figsize=(3.5, 2.5))
 
     ax.set_xlabel(r"$g_{\mathrm{GF}}^2$")
@@ -49,7 +54,8 @@ def plot(beta_continuum):
         )
 
     _, xmax = ax.get_xlim()
-    add_perturbative_lines(ax, 0, xmax, "fun", 12, 3)
+    if not draft:
+        add_perturbative_lines(ax, 0, xmax, "fun", 12, 3)
     ax.set_xlim(0, xmax)
     ax.set_ylim(-0.3, 0.7)
 
@@ -61,9 +67,9 @@ def plot(beta_continuum):
 
 def main():
     args = get_args()
-    plt.style.use(args.plot_styles)
+    use_styles(args.plot_styles, draft=args.draft)
     beta_continuum = read_all_fit_results(args.fit_filenames)
-    save_or_show(plot(beta_continuum), args.plot_filename)
+    save_or_show(plot(beta_continuum, draft=args.draft), args.plot_filename)
 
 
 if __name__ == "__main__":
@@ -4,9 +4,9 @@ import argparse
 
 import matplotlib.pyplot as plt
 
-from fit_beta_against_g2 import interpolating_form
+from fit_beta_against_g2 import interpolating_form, select_order
 from names import operator_names
-from plots import PlotPropRegistry, errorbar_pyerrors, legend, save_or_show
+from plots import PlotPropRegistry, errorbar_pyerrors, legend, save_or_show, use_styles
 from plot_infinite_volume_extrapolation import plot_fit
 from read import read_all_fit_results
 
@@ -17,6 +17,11 @@ def get_args():
     parser.add_argument("--unfit_filenames", metavar="unfit_filename", nargs="+")
     parser.add_argument("--tick_times", metavar="tick_time", type=float, nargs="+")
     parser.add_argument("--plot_styles", default="styles/paperdraft.mplstyle")
+    parser.add_argument(
+        "--draft",
+        action="store_true",
+        help="Render with mathtext at 150 dpi, without TeX",
+    )
     parser.add_argument("--output_filename", default=None)
     return parser.parse_args()
 
@@ -28,12 +33,11 @@ def plot_single(ax, fit, use_fit, colours, markers):
         [source["filename"] for source in fit["data_sources"]]
     )
     spacings = [1 / datum["time"] for datum in point_data]
-    beta_values = [
-        interpolating_form(
-            datum["beta_interpolation"], fit["g_squared"], n=datum["order"]
-        )
-        for datum in point_data
-    ]
+    beta_values = []
+    for datum in point_data:
+        # As the continuum extrapolation selected it
+        parameters, order = select_order(datum, fit.get("interpolation_order"))
+        beta_values.append(interpolating_form(parameters, fit["g_squared"], n=order))
     for value in beta_values:
         value.gamma_method()
     errorbar_pyerrors(
@@ -95,7 +99,7 @@ def plot(fit_data, unfit_data, tick_times=[]):
 
 def main():
     args = get_args()
-    plt.style.use(args.plot_styles)
+    use_styles(args.plot_styles, draft=args.draft)
 
     fit_data = read_all_fit_results(args.fit_filenames)
     unfit_data = read_all_fit_results(args.unfit_filenames)
@@ -5,7 +5,7 @@ import argparse
 import matplotlib.pyplot as plt
 
 from names import operator_names
-from plots import PlotPropRegistry, legend, save_or_show
+from plots import PlotPropRegistry, legend, save_or_show, use_styles
 from read import read_all_fit_results
 
 
@@ -14,6 +14,11 @@ def get_args():
     parser.add_argument("fit_filenames", nargs="+", metavar="beta_continuum_filename")
     parser.add_argument("--plot_filename", default=None)
     parser.add_argument("--plot_styles", default="styles/paperdraft.mplstyle")
+    parser.add_argument(
+        "--draft",
+        action="store_true",
+        help="Render with mathtext at 150 dpi, without TeX",
+    )
     return parser.parse_args()
 
 
@@ -77,7 +82,7 @@ def plot(data):
 
 def main():
     args = get_args()
-    plt.style.use(args.plot_styles)
+    use_styles(args.plot_styles, draft=args.draft)
     fit_results = read_all_fit_results(args.fit_filenames, pyerrors=False)
     save_or_show(plot(fit_results), args.plot_filename)
 
@@ -4,17 +4,27 @@ import argparse
 
 import matplotlib.pyplot as plt
 import numpy as np
-import pyerrors as pe
 
-from extrapolate_infinite_volume import get_scales_at_time, linear_fit
-from plots import PlotPropRegistry, errorbar_pyerrors, save_or_show
-from read import get_all_flows, read_all_fit_results
+from extrapolate_infinite_volume import linear_fit, linear_fit_jacobian, scales
+from plots import (
+    PlotPropRegistry,
+    error_band,
+    errorbar_pyerrors,
+    save_or_show,
+    use_styles,
+)
+from read import read_all_fit_results
 
 
 def get_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("fit_filenames", metavar="fit_filename", nargs="+")
     parser.add_argument("--plot_styles", default="styles/paperdraft.mplstyle")
+    parser.add_argument(
+        "--draft",
+        action="store_true",
+        help="Render with mathtext at 150 dpi, without TeX",
+    )
     parser.add_argument("--output_filename", default=None)
     return parser.parse_args()
 
@@ -22,7 +32,7 @@ def get_args():
 def plot_fit(ax, fit_result, xmax, colour=None):
     scan_x = np.linspace(0, xmax, 1000)
     scan_y = linear_fit(np.asarray(fit_result, dtype=float), scan_x)
-    scan_errors = pe.fits.error_band(scan_x, linear_fit, fit_result)
+    scan_errors = error_band(scan_x, linear_fit_jacobian, fit_result)
     ax.plot(scan_x, scan_y, dashes=(3, 2), color=colour)
     ax.fill_between(
         scan_x, scan_y + scan_errors, scan_y - scan_errors, color=colour, alpha=0.2
@@ -31,21 +41,17 @@ def plot_fit(ax, fit_result, xmax, colour=None):
 
 def add_finite_L(ax_row, fit_result, colours):
     time = fit_result["time"]
-    flows = get_all_flows(
-        [ens["filename"] for ens in fit_result["data_sources"]],
-        operator=fit_result["operator"],
-        extra_metadata={"Nc": fit_result["Nc"]},
-    )
-    x_values = [1 / flow["NX"] ** 4 for flow in flows]
-    gGF2_values = get_scales_at_time(flows, "gGF^2", time)
-    betaGF_values = get_scales_at_time(flows, "betaGF", time)
+    x_values = [1 / ens["NX"] ** 4 for ens in fit_result["data_sources"]]
 
-    for ax, y_values in zip(ax_row, [gGF2_values, betaGF_values]):
+    for ax, scale in zip(ax_row, scales):
+        y_values = [ens[scale] for ens in fit_result["finite_volume"]]
+        for value in y_values:
+            value.gamma_method()
         errorbar_pyerrors(ax, x_values, y_values, color=colours[time], marker="x")
 
 
 def add_extrapolation_band(ax_row, fit_result, colours):
-    for ax, scale in zip(ax_row, ["gGF^2", "betaGF"]):
+    for ax, scale in zip(ax_row, scales):
         result = fit_result[scale]
         time = fit_result["time"]
         x_min, x_max = ax.get_xlim()
@@ -124,7 +130,7 @@ def plot_g2_vs_L(fit_results, filename=None):
 
 def main():
     args = get_args()
-    plt.style.use(args.plot_styles)
+    use_styles(args.plot_styles, draft=args.draft)
 
     fit_results = read_all_fit_results(args.fit_filenames)
     save_or_show(plot_g2_vs_L(fit_results), args.output_filename)
@@ -51,6 +51,15 @@ def errorbar_pyerrors(ax, x, y, *args, **kwargs):
     )
 
 
+def error_band(x, jacobian, fit_parameters):
+    # Equivalent to pe.fits.error_band for fit forms that are linear
+    # in their parameters, but using the analytic Jacobian of shape
+    # (len(fit_parameters), len(x)) so the whole band is a single contraction
+    derivatives = jacobian(np.asarray(x, dtype=float))
+    covariance = pe.covariance(list(fit_parameters))
+    return np.sqrt(np.einsum("ix,ij,jx->x", derivatives, covariance, derivatives))
+
+
 def legend(ax, entries, attr, mapping, columns, position, fig=None):
     handles = []
     for key, value in entries.items():
@@ -74,6 +83,20 @@ def legend(ax, entries, attr, mapping, columns, position, fig=None):
         return ax.legend(handles=handles, loc=position, ncols=columns)
 
 
+def use_styles(styles, draft=False):
+    plt.style.use(styles)
+    if draft:
+        # mathtext and raster output at screen resolution; no TeX install needed
+        plt.rcParams.update(
+            {
+                "text.usetex": False,
+                "font.serif": plt.rcParamsDefault["font.serif"],
+                "mathtext.fontset": "cm",
+                "savefig.dpi": 150,
+            }
+        )
+
+
 def save_or_show(fig, filename=None):
     if filename is not None:
         fig.savefig(filename)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+import copy
+
+import numpy as np
+import pyerrors as pe
+
+from linear_corr import LinearCorr
+
+# Opt-in reduced precision for stored Monte Carlo deltas.
+#
+# Deltas held in single precision (in the joblib cache or in shared memory)
+# are rounded by at most 2**-24 ~ 6e-8 of their own magnitude.
+# Deltas written to intermediary JSON are rounded to `significant_digits`
+# relative to the largest delta of each ensemble, i.e. by at most
+#     eta = 5e-8 * max|delta|.
+# Either way the central value moves by at most eta,
+# and the error by a relative amount of at most about eta / rms(delta),
+# which is far below the uncertainty on the error itself.
+# Arithmetic is always done in double precision:
+# single precision deltas are upcast before they are used.
+
+significant_digits = 8
+
+# Autocorrelation functions kept by Obs.gamma_method,
+# which take up more space than the deltas themselves
+_gamma_method_arrays = ["e_rho", "e_drho", "e_n_tauint", "e_n_dtauint"]
+
+
+def _map_obs(function, obj):
+    # Apply function in place to every Obs in a (nested) container
+    if isinstance(obj, pe.Obs):
+        function(obj)
+    elif isinstance(obj, LinearCorr):
+        # Laid out like an Obs; shared with other LinearCorr,
+        # so converting it again leaves it unchanged
+        function(obj.samples)
+    elif isinstance(obj, pe.Corr):
+        for element in obj.content:
+            if element is not None:
+                _map_obs(function, element)
+    elif isinstance(obj, dict):
+        for value in obj.values():
+            _map_obs(function, value)
+    elif isinstance(obj, (list, tuple)) or (
+        isinstance(obj, np.ndarray) and obj.dtype == object
+    ):
+        for value in obj:
+            _map_obs(function, value)
+    return obj
+
+
+def _convert(obs, dtype):
+    for arrays in [obs.deltas] + [
+        getattr(obs, attribute)
+        for attribute in _gamma_method_arrays
+        if hasattr(obs, attribute)
+    ]:
+        for name, array in arrays.items():
+            arrays[name] = np.asarray(array, dtype=dtype)
+
+
+def _to_single(obs):
+    _convert(obs, np.float32)
+
+
+def _round(obs):
+    for name, deltas in obs.deltas.items():
+        scale = np.max(np.abs(deltas))
+        if scale > 0:
+            decimals = significant_digits - 1 - int(np.floor(np.log10(scale)))
+            obs.deltas[name] = np.round(deltas, decimals)
+
+
+def single_precision(obj):
+    return _map_obs(_to_single, obj)
+
+
+def rounded(obj):
+    # A copy of obj with deltas short enough to be written compactly to JSON
+    return _map_obs(_round, copy.deepcopy(obj))
@@ -1,28 +1,38 @@
 #!/usr/bin/env python3
 
+import bz2
+import concurrent.futures
 import gzip
+import hashlib
+import logging
+import lzma
+import os
+import pickle
 import re
+import shutil
+import tempfile
+import threading
 
 from flow_analysis.readers import readers
 
+import joblib
 from joblib import Memory
 import mpmath
 import numpy as np
 import pyerrors as pe
 import rapidjson as json
 
-from utils import partial_corr_mult
+from linear_corr import LinearCorr
+from precision import single_precision
 
 mpmath.mp.dps = 25
 memory = Memory("cache")
+incremental_directory = os.path.join("cache", "incremental")
 
 
 def t_times_d_dt(corr, times, time_step, variant="symmetric"):
-    # pyerrors can't cope if you multiply a derivative by a sequence,
-    # as some elements are None
-
     d_corr_dt = corr.deriv(variant) / time_step
-    return partial_corr_mult(times, d_corr_dt)
+    return d_corr_dt.scaled(times)
 
 
 def normalize_coupling(corr, times, Nc, L):
@@ -43,7 +53,7 @@ def normalize_coupling(corr, times, Nc, L):
         128 * mpmath.pi**2 / (element * 3 * (Nc**2 - 1)) for element in delta_plus_one
     ]
 
-    return partial_corr_mult(np.asarray(coefficient, float), corr)
+    return corr.scaled(np.asarray(coefficient, float))
 
 
 def get_metadata_from_filename(filename):
@@ -57,9 +67,61 @@ def get_metadata_from_filename(filename):
     return {"NT": nt, "NX": nx, "NY": nx, "NZ": nx, "beta": beta}
 
 
+compressed_openers = {".gz": gzip.open, ".xz": lzma.open, ".bz2": bz2.open}
+
+
+def _get_opener(filename):
+    return compressed_openers.get(os.path.splitext(filename)[1])
+
+
+def _decompress_into(source, pipe_filename, errors):
+    try:
+        with open(pipe_filename, "wb") as sink:
+            shutil.copyfileobj(source, sink, 1 << 20)
+    except BrokenPipeError:
+        # The reader stopped before the end of the file
+        pass
+    except Exception as ex:
+        errors.append(ex)
+
+
+def read_flows(filename, reader="hp"):
+    # Compressed files are decompressed a chunk at a time as the reader
+    # consumes them, through a named pipe with the uncompressed file name,
+    # so that no decompressed copy is written or held in memory
+    opener = _get_opener(filename)
+    if opener is None:
+        return readers[reader](filename)
+
+    errors = []
+    with opener(filename, "rb") as source, tempfile.TemporaryDirectory() as directory:
+        pipe_filename = os.path.join(
+            directory, os.path.basename(os.path.splitext(filename)[0])
+        )
+        os.mkfifo(pipe_filename)
+        writer = threading.Thread(
+            target=_decompress_into, args=(source, pipe_filename, errors)
+        )
+        writer.start()
+        try:
+            flows = readers[reader](pipe_filename)
+        finally:
+            while writer.is_alive():
+                # Release a writer still waiting for the reader to open the pipe
+                os.close(os.open(pipe_filename, os.O_RDONLY | os.O_NONBLOCK))
+                writer.join(0.1)
+            if errors:
+                # A corrupt file looks truncated to the reader,
+                # so report the underlying error instead
+                raise errors[0]
+
+    flows.filename = filename
+    return flows
+
+
 @memory.cache
 def get_flows(filename, reader="hp", extra_metadata=None):
-    flows = readers[reader](filename)
+    flows = read_flows(filename, reader)
     metadata = get_metadata_from_filename(filename)
     flows.metadata.update(metadata)
     if extra_metadata is not None:
@@ -67,29 +129,393 @@ def get_flows(filename, reader="hp", extra_metadata=None):
     return flows
 
 
-@memory.cache
-def get_all_flows(filenames, reader="hp", operator="sym", extra_metadata=None):
-    result = []
+def bin_obs(obs, bin_size):
+    # Averages consecutive measurements; any trailing partial bin is dropped
+    samples, names, idl = [], [], []
+    for name in obs.names:
+        history = obs.deltas[name] + obs.r_values[name]
+        num_bins = len(history) // bin_size
+        samples.append(
+            history[: num_bins * bin_size].reshape(num_bins, bin_size).mean(axis=1)
+        )
+        names.append(name)
+        idl.append(range(1, num_bins + 1))
+    return pe.Obs(samples, names, idl=idl)
+
+
+def bin_corr(corr, bin_size):
+    return pe.Corr(
+        [
+            None if element is None else bin_obs(element[0], bin_size)
+            for element in corr.content
+        ]
+    )
+
+
+def get_auto_bin_size(corr):
+    # Bins of twice the largest integrated autocorrelation time
+    # seen at any flow time
+    tau_int = 0.5
+    for element in corr.content:
+        if element is None:
+            continue
+        element[0].gamma_method()
+        tau_int = max(tau_int, *element[0].e_tauint.values())
+    return int(np.ceil(2 * tau_int))
+
+
+def get_t2E(filename, reader="hp", operator="sym", extra_metadata=None):
+    flows = get_flows(filename, reader, extra_metadata)
+    metadata = {**flows.metadata, "filename": flows.filename, "h": flows.h}
+    return (
+        metadata,
+        flows.times,
+        flows.times**2 * flows.get_Es_pyerrors(operator=operator),
+    )
+
+
+def _get_digests(filename, sizes):
+    # SHA-256 of the first size bytes of filename for each of sizes,
+    # from a single pass over the file
+    digest = hashlib.sha256()
+    digests = {}
+    position = 0
+    with open(filename, "rb") as f:
+        for size in sorted(set(sizes)):
+            while position < size:
+                chunk = f.read(min(size - position, 1 << 20))
+                if not chunk:
+                    break
+                digest.update(chunk)
+                position += len(chunk)
+            digests[size] = digest.hexdigest()
+    return digests
+
+
+def _get_state_filename(filename, reader, operator):
+    return os.path.join(
+        incremental_directory,
+        joblib.hash((os.path.abspath(filename), reader, operator)) + ".pkl",
+    )
+
+
+def _load_state(state_filename):
+    if not os.path.exists(state_filename):
+        return None
+    with open(state_filename, "rb") as f:
+        return pickle.load(f)
+
+
+def _save_state(state_filename, state):
+    os.makedirs(incremental_directory, exist_ok=True)
+    temporary_filename = f"{state_filename}.{os.getpid()}"
+    with open(temporary_filename, "wb") as f:
+        pickle.dump(state, f)
+    os.replace(temporary_filename, state_filename)
+
+
+def _get_complete_size(filename):
+    # Ignore any partially-written final line;
+    # compressed files can't be split, so are only ever read in full
+    size = os.path.getsize(filename)
+    if _get_opener(filename) is not None:
+        return size
+    with open(filename, "rb") as f:
+        f.seek(max(size - (1 << 16), 0))
+        tail = f.read()
+    return size - len(tail) + tail.rfind(b"\n") + 1
+
+
+def _read_appended(filename, reader, start, end):
+    # The appended records are parsed on their own,
+    # under the same file name so that the reader sees familiar metadata
+    with tempfile.TemporaryDirectory() as directory:
+        tail_filename = os.path.join(directory, os.path.basename(filename))
+        with open(filename, "rb") as source, open(tail_filename, "wb") as tail:
+            source.seek(start)
+            tail.write(source.read(end - start))
+        return readers[reader](tail_filename)
+
+
+def _extend_obs(obs, extension):
+    (name,) = obs.names
+    (extension_name,) = extension.names
+    idl = list(obs.idl[name])
+    extension_idl = np.asarray(extension.idl[extension_name])
+    if extension_idl[0] <= idl[-1]:
+        # Configurations numbered from the start of the appended records
+        step = idl[1] - idl[0] if len(idl) > 1 else 1
+        extension_idl += idl[-1] + step - extension_idl[0]
+
+    return pe.Obs(
+        [
+            np.concatenate(
+                [
+                    obs.deltas[name] + obs.r_values[name],
+                    extension.deltas[extension_name]
+                    + extension.r_values[extension_name],
+                ]
+            )
+        ],
+        [name],
+        idl=[idl + extension_idl.tolist()],
+    )
+
+
+def _extend_corr(corr, extension):
+    return pe.Corr(
+        [
+            None if element is None else _extend_obs(element[0], extension_element[0])
+            for element, extension_element in zip(corr.content, extension.content)
+        ]
+    )
+
+
+def get_t2E_incremental(filename, reader="hp", operator="sym", extra_metadata=None):
+    # As get_t2E, but kept up to date with files that are only ever appended to:
+    # growth is detected by checking that the previously-read bytes are
+    # unchanged, and only the new records are parsed.
+    # Anything else (or appended records that cannot be read on their own)
+    # leads to the whole file being re-read.
+    state_filename = _get_state_filename(filename, reader, operator)
+    state = _load_state(state_filename)
+    size = _get_complete_size(filename)
+
+    digests = {}
+    if (
+        state is not None
+        and state["extra_metadata"] == extra_metadata
+        and state["size"] <= size
+        and (state["size"] == size or _get_opener(filename) is None)
+    ):
+        # The digest of the whole file is kept for the new state
+        digests = _get_digests(filename, [state["size"], size])
+    if state is not None and digests.get(state["size"]) == state["digest"]:
+        if state["size"] == size:
+            return state["metadata"], state["times"], state["t2E"], "unchanged"
+
+        try:
+            flows = _read_appended(filename, reader, state["size"], size)
+            if flows.h != state["metadata"]["h"] or not np.array_equal(
+                flows.times, state["times"]
+            ):
+                raise ValueError("Appended records have different flow times.")
+            t2E = _extend_corr(
+                state["t2E"], flows.times**2 * flows.get_Es_pyerrors(operator=operator)
+            )
+            status = "appended"
+        except Exception as ex:
+            # The reader may not cope with a file fragment in arbitrary ways
+            logging.warning(f"Re-reading {filename} in full: {ex}")
+            state = None
+    else:
+        state = None
+
+    if state is None:
+        flows = read_flows(filename, reader)
+        flows.metadata.update(get_metadata_from_filename(filename))
+        if extra_metadata is not None:
+            flows.metadata.update(extra_metadata)
+        metadata = {**flows.metadata, "filename": filename, "h": flows.h}
+        times = flows.times
+        t2E = flows.times**2 * flows.get_Es_pyerrors(operator=operator)
+        status = "full"
+    else:
+        metadata, times = state["metadata"], state["times"]
+
+    if size not in digests:
+        digests = _get_digests(filename, [size])
+    _save_state(
+        state_filename,
+        {
+            "size": size,
+            "digest": digests[size],
+            "extra_metadata": extra_metadata,
+            "metadata": metadata,
+            "times": times,
+            "t2E": t2E,
+        },
+    )
+    return metadata, times, t2E, status
+
+
+def grown_inputs(filenames, reader="hp", operator="sym"):
+    # Cheap check, without reading any data, for which files have changed size
+    # since they were last ingested incrementally
+    grown = []
     for filename in filenames:
-        flows = get_flows(filename, reader, extra_metadata)
-        datum = {
-            **flows.metadata,
-            "filename": flows.filename,
-            "h": flows.h,
-            "t2E": flows.times**2 * flows.get_Es_pyerrors(operator=operator),
-        }
-        datum["gGF^2"] = normalize_coupling(
-            datum["t2E"], flows.times, datum["Nc"], datum["NX"]
+        state = _load_state(_get_state_filename(filename, reader, operator))
+        if state is None or _get_complete_size(filename) != state["size"]:
+            grown.append(filename)
+    return grown
+
+
+def ingest_flows(
+    filename,
+    reader="hp",
+    operator="sym",
+    extra_metadata=None,
+    bin_size=None,
+    incremental=False,
+):
+    if incremental:
+        metadata, times, t2E, status = get_t2E_incremental(
+            filename, reader, operator, extra_metadata
         )
-        datum["betaGF"] = -t_times_d_dt(
-            datum["gGF^2"], flows.times, flows.h, variant="improved"
+        logging.info(f"{filename}: {status}")
+    else:
+        metadata, times, t2E = get_t2E(filename, reader, operator, extra_metadata)
+
+    num_configurations = len(t2E[0].idl[t2E[0].names[0]])
+    if bin_size == "auto":
+        bin_size = get_auto_bin_size(t2E)
+    if bin_size is None:
+        bin_size = 1
+    if bin_size > 1:
+        t2E = bin_corr(t2E, bin_size)
+
+    # gGF^2 and betaGF are linear in t2E, so are held as linear maps
+    # over its deltas rather than as Obs with deltas of their own
+    datum = {
+        **metadata,
+        "num_configurations": num_configurations,
+        "bin_size": bin_size,
+        "t2E": LinearCorr.from_corr(t2E),
+    }
+    datum["gGF^2"] = normalize_coupling(datum["t2E"], times, datum["Nc"], datum["NX"])
+    datum["betaGF"] = -t_times_d_dt(
+        datum["gGF^2"], times, datum["h"], variant="improved"
+    )
+
+    return datum
+
+
+# Part of the key of the cached results below, and to be increased whenever
+# what ingest_flows returns changes form: joblib notices changes to the code
+# of the cached functions themselves, but not to the functions they call.
+# 2: t2E, gGF^2 and betaGF are LinearCorr over shared samples
+cache_format = 2
+
+
+def _ingest_all(
+    filenames,
+    reader,
+    operator,
+    extra_metadata,
+    bin_size,
+    incremental,
+    workers=1,
+    cache_format=cache_format,
+):
+    if isinstance(bin_size, (list, tuple)):
+        bin_sizes = bin_size
+    else:
+        bin_sizes = [bin_size] * len(filenames)
+
+    arguments = [
+        (filename, reader, operator, extra_metadata, ensemble_bin_size, incremental)
+        for filename, ensemble_bin_size in zip(filenames, bin_sizes)
+    ]
+    if workers > 1 and len(arguments) > 1:
+        # Ensembles are independent; map keeps the results in input order
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=min(workers, len(arguments)),
+            initializer=use_cache,
+            initargs=(memory.location,),
+        ) as executor:
+            return list(executor.map(ingest_flows, *zip(*arguments)))
+
+    return [ingest_flows(*ensemble_arguments) for ensemble_arguments in arguments]
+
+
+_get_all_flows_cached = memory.cache(_ingest_all, ignore=["workers"])
+
+
+def _ingest_all_single(
+    filenames,
+    reader,
+    operator,
+    extra_metadata,
+    bin_size,
+    incremental,
+    workers=1,
+    cache_format=cache_format,
+):
+    return single_precision(
+        _ingest_all(
+            filenames,
+            reader,
+            operator,
+            extra_metadata,
+            bin_size,
+            incremental,
+            workers=workers,
+            cache_format=cache_format,
         )
+    )
+
+
+# Half the size on disk and to unpickle; see precision.py
+_get_all_flows_single_cached = memory.cache(_ingest_all_single, ignore=["workers"])
 
-        for key in "t2E", "gGF^2", "betaGF":
-            datum[key].gamma_method()
 
-        result.append(datum)
-    return result
+def use_cache(location):
+    # Keep the joblib caches above, and the state of incremental reads,
+    # under location rather than cache, so that separate runs aren't served
+    # each other's results; spawned worker processes need to call this too
+    global memory, incremental_directory, get_flows
+    global _get_all_flows_cached, _get_all_flows_single_cached
+    memory = Memory(location)
+    incremental_directory = os.path.join(location, "incremental")
+    get_flows = memory.cache(get_flows.func)
+    _get_all_flows_cached = memory.cache(_ingest_all, ignore=["workers"])
+    _get_all_flows_single_cached = memory.cache(_ingest_all_single, ignore=["workers"])
+
+
+def get_all_flows(
+    filenames,
+    reader="hp",
+    operator="sym",
+    extra_metadata=None,
+    bin_size=None,
+    incremental=False,
+    workers=1,
+    reduced_precision=False,
+):
+    if incremental:
+        # Freshness is checked against the files themselves on every call,
+        # so this bypasses the joblib cache
+        return _ingest_all(
+            filenames,
+            reader,
+            operator,
+            extra_metadata,
+            bin_size,
+            incremental=True,
+            workers=workers,
+        )
+    if reduced_precision:
+        # Kept in single precision, as LinearCorr upcasts each Obs it builds
+        return _get_all_flows_single_cached(
+            filenames,
+            reader,
+            operator,
+            extra_metadata,
+            bin_size,
+            incremental=False,
+            workers=workers,
+            cache_format=cache_format,
+        )
+    return _get_all_flows_cached(
+        filenames,
+        reader,
+        operator,
+        extra_metadata,
+        bin_size,
+        incremental=False,
+        workers=workers,
+        cache_format=cache_format,
+    )
 
 
 def recurse_gamma(obj):
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+
+import zlib
+
+import numpy as np
+import pyerrors as pe
+import scipy.linalg
+
+# An alternative to propagating errors with pyerrors' Obs arithmetic:
+# the Obs entering a stage are turned into samples of each ensemble,
+# the stage computes with NumPy over the sample axis,
+# and its results are turned back into Obs to be written as before.
+# Ensembles are resampled one at a time, with the others held at their
+# central values, so that each result's deltas on each ensemble,
+# and so its errors and correlations, can be recovered.
+
+methods = ["jackknife", "bootstrap"]
+
+
+def add_arguments(parser):
+    parser.add_argument(
+        "--resampling",
+        choices=methods,
+        default=None,
+        help=(
+            "Propagate errors by resampling each ensemble, "
+            "rather than by the linearised Obs arithmetic of pyerrors"
+        ),
+    )
+    parser.add_argument(
+        "--bootstrap_samples",
+        type=int,
+        default=1000,
+        help="Samples per ensemble for --resampling bootstrap",
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="Seed for --resampling bootstrap"
+    )
+
+
+def from_args(args):
+    if args.resampling is None:
+        return None
+    return Resampler(args.resampling, args.bootstrap_samples, args.seed)
+
+
+def from_config(config):
+    if not config.get("resampling"):
+        return None
+    return Resampler(
+        config["resampling"],
+        config.get("bootstrap_samples", 1000),
+        config.get("resampling_seed", 0),
+    )
+
+
+class Resampler:
+    # The samples drawn of an ensemble depend only on its name, its length
+    # and the seed, so stages resampling the same ensemble agree
+
+    def __init__(self, method="jackknife", num_samples=1000, seed=0):
+        if method not in methods:
+            raise ValueError(f"Unknown resampling method {method}.")
+        self.method = method
+        self.num_samples = num_samples
+        self.seed = seed
+        self._inverses = {}
+
+    def describe(self):
+        if self.method == "jackknife":
+            return {"method": self.method}
+        return {"method": self.method, "samples": self.num_samples, "seed": self.seed}
+
+    def _counts(self, name, length):
+        # How often each configuration is drawn in each bootstrap sample
+        if self.num_samples < length:
+            raise ValueError(
+                f"{self.num_samples} bootstrap samples can't be turned back into "
+                f"an Obs on {name}, which has {length} configurations."
+            )
+        rng = np.random.default_rng([self.seed, zlib.crc32(name.encode())])
+        draws = rng.integers(length, size=(self.num_samples, length))
+        draws += length * np.arange(self.num_samples)[:, np.newaxis]
+        return np.bincount(draws.ravel(), minlength=self.num_samples * length).reshape(
+            self.num_samples, length
+        )
+
+    def _shifts(self, name, deltas):
+        # Shift from the central value in each sample of deltas,
+        # an array of shape (num_configurations, num_observables)
+        length = len(deltas)
+        if self.method == "jackknife":
+            return -deltas / (length - 1)
+        return self._counts(name, length) @ deltas / length
+
+    def _deltas(self, name, length, shifts):
+        # The inverse of _shifts
+        if self.method == "jackknife":
+            deltas = (length - 1) * (shifts.mean(axis=0) - shifts)
+        else:
+            # The least squares solution, as pe.import_bootstrap;
+            # kept for each ensemble, as results are converted many times
+            if (name, length) not in self._inverses:
+                self._inverses[name, length] = scipy.linalg.pinv(
+                    self._counts(name, length) / length
+                )
+            deltas = self._inverses[name, length] @ shifts
+        return deltas - deltas.mean(axis=0)
+
+    def resample(self, observables):
+        # Samples of an array of Obs; other numbers are taken as exact
+        observables = np.asarray(observables, dtype=object)
+        flat = observables.ravel()
+        ensembles = {}
+        for value in flat:
+            if not isinstance(value, pe.Obs):
+                continue
+            if value.cov_names:
+                raise ValueError("Can't resample an Obs with covariance inputs.")
+            for name in value.mc_names:
+                if ensembles.setdefault(name, value.idl[name]) != value.idl[name]:
+                    raise ValueError(f"Inconsistent configurations for {name}.")
+
+        central = np.asarray([getattr(value, "value", value) for value in flat])
+        rows = [central[np.newaxis]]
+        for name, idl in sorted(ensembles.items()):
+            deltas = np.zeros((len(idl), len(flat)))
+            for column, value in enumerate(flat):
+                if isinstance(value, pe.Obs) and name in value.deltas:
+                    deltas[:, column] = value.deltas[name]
+            rows.append(central + self._shifts(name, deltas))
+
+        return Samples(
+            np.concatenate(rows).reshape(-1, *observables.shape),
+            sorted(ensembles.items()),
+            self,
+        )
+
+
+class Samples:
+    # An array of observables resampled by a Resampler:
+    # values[0] holds the central values, followed by the samples of each
+    # ensemble in turn, so any function applied independently to each row
+    # of values gives the samples of its result
+
+    def __init__(self, values, ensembles, resampler):
+        self.values = values
+        self.ensembles = ensembles
+        self.resampler = resampler
+
+    @property
+    def central(self):
+        return self.values[0]
+
+    def derived(self, values):
+        if len(values) != len(self.values):
+            raise ValueError("Derived values must keep the sample axis.")
+        return Samples(values, self.ensembles, self.resampler)
+
+    def _blocks(self):
+        start = 1
+        for name, idl in self.ensembles:
+            length = (
+                len(idl)
+                if self.resampler.method == "jackknife"
+                else self.resampler.num_samples
+            )
+            yield name, idl, self.values[start : start + length]
+            start += length
+
+    def to_obs(self):
+        shape = self.values.shape[1:]
+        central = self.central.ravel()
+        names, idls, deltas = [], [], []
+        for name, idl, block in self._blocks():
+            shifts = block.reshape(len(block), -1) - central
+            names.append(name)
+            idls.append(idl)
+            deltas.append(self.resampler._deltas(name, len(idl), shifts))
+
+        result = np.empty(len(central), dtype=object)
+        for column, value in enumerate(central):
+            # Ensembles on which this result doesn't depend are left out
+            used = [
+                index
+                for index, ensemble_deltas in enumerate(deltas)
+                if ensemble_deltas[:, column].any()
+            ] or list(range(len(names)))
+            result[column] = pe.Obs(
+                [deltas[index][:, column] for index in used],
+                [names[index] for index in used],
+                idl=[idls[index] for index in used],
+                means=[value] * len(used),
+            )
+            result[column]._value = value
+        return result.reshape(shape)
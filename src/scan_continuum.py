@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+
+import numpy as np
+import pyerrors as pe
+
+import catalog
+import resampling
+from extrapolate_continuum import (
+    fit as fit_continuum,
+    fit_resampled as fit_continuum_resampled,
+    get_metadata,
+    resample_interpolations,
+)
+from fit_fixed_point import (
+    fit as fit_fixed_point,
+    fit_resampled as fit_fixed_point_resampled,
+)
+from precision import rounded
+from read import read_all_fit_results
+from utils import interpolation_order
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input_filenames", metavar="input_filename", nargs="+")
+    parser.add_argument("--g_squared_min", type=float, required=True)
+    parser.add_argument("--g_squared_max", type=float, required=True)
+    parser.add_argument("--initial_points", type=int, default=9)
+    parser.add_argument("--max_points", type=int, default=128)
+    parser.add_argument("--min_spacing", type=float, default=0.05)
+    parser.add_argument("--curvature_tolerance", type=float, default=0.5)
+    parser.add_argument("--tolerance", type=float, default=0.05)
+    parser.add_argument("--output_directory", default=None)
+    parser.add_argument(
+        "--interpolation_order",
+        default=None,
+        type=interpolation_order,
+        help=(
+            "Use this order (or 'average') of interpolations fit with several "
+            "orders, rather than the one they pass on by default"
+        ),
+    )
+    parser.add_argument(
+        "--reduced_precision",
+        action="store_true",
+        help="Write deltas rounded to 8 significant digits; see precision.py",
+    )
+    resampling.add_arguments(parser)
+    catalog.add_argument(parser)
+    return parser.parse_args()
+
+
+def continuum_point(data, g_squared, interpolation_order=None, parameters=None):
+    # When resampling, parameters from resample_interpolations are shared
+    # by every point, and each point keeps its samples for the fixed point
+    if parameters is None:
+        resampler = None
+        point = {
+            "continuum_extrapolation": fit_continuum(
+                data, g_squared, interpolation_order
+            )
+        }
+    else:
+        resampler = parameters.resampler
+        samples = fit_continuum_resampled(data, parameters, g_squared)
+        point = {"continuum_extrapolation": list(samples.to_obs()), "samples": samples}
+    for param in point["continuum_extrapolation"]:
+        param.gamma_method()
+    return {**get_metadata(data, g_squared, interpolation_order, resampler), **point}
+
+
+def _chord_deviation(x, y):
+    # Deviation of each interior point from the straight line
+    # through its two neighbours
+    weight = (x[1:-1] - x[:-2]) / (x[2:] - x[:-2])
+    return np.abs(y[1:-1] - (y[:-2] + weight * (y[2:] - y[:-2])))
+
+
+def intervals_to_refine(points, curvature_tolerance, min_spacing):
+    g_squared = np.asarray([point["g_squared"] for point in points])
+    beta = [point["continuum_extrapolation"][0] for point in points]
+    centre = np.asarray([value.value for value in beta])
+    error = np.asarray([value.dvalue for value in beta])
+
+    flagged = set()
+
+    # fit_fixed_point looks for roots of the centre and both edges of the band
+    for band in centre, centre + error, centre - error:
+        flagged.update(np.flatnonzero(band[:-1] * band[1:] <= 0))
+
+    # Curvature of the central value or of the error that a linear
+    # interpolation between samples would miss
+    rough = (
+        _chord_deviation(g_squared, centre) > curvature_tolerance * error[1:-1]
+    ) | (_chord_deviation(g_squared, error) > curvature_tolerance * error[1:-1])
+    for index in np.flatnonzero(rough) + 1:
+        flagged.update([index - 1, index])
+
+    return [
+        index
+        for index in sorted(flagged)
+        if g_squared[index + 1] - g_squared[index] >= 2 * min_spacing
+    ]
+
+
+def get_fixed_point(points):
+    try:
+        if "samples" not in points[0]:
+            return fit_fixed_point(points)
+        # The samples of all points derive from the same resampled parameters
+        beta = np.stack([point["samples"].values[:, 0] for point in points], axis=1)
+        return fit_fixed_point_resampled(
+            [point["g_squared"] for point in points],
+            points[0]["samples"].derived(beta),
+        )
+    except ValueError:
+        return None
+
+
+def is_stable(previous, current, tolerance):
+    if previous is None or current is None:
+        return False
+    return all(
+        abs(old.nominal_value - new.nominal_value) <= tolerance * new.std_dev
+        and abs(old.std_dev - new.std_dev) <= tolerance * new.std_dev
+        for old, new in zip(previous, current)
+    )
+
+
+def scan(
+    data,
+    g_squared_min,
+    g_squared_max,
+    initial_points=9,
+    max_points=128,
+    min_spacing=0.05,
+    curvature_tolerance=0.5,
+    tolerance=0.05,
+    interpolation_order=None,
+    resampler=None,
+):
+    parameters = (
+        None
+        if resampler is None
+        else resample_interpolations(data, resampler, interpolation_order)
+    )
+    points = [
+        continuum_point(data, round(g_squared, 6), interpolation_order, parameters)
+        for g_squared in np.linspace(g_squared_min, g_squared_max, initial_points)
+    ]
+    fixed_point = get_fixed_point(points)
+
+    while len(points) < max_points:
+        indices = intervals_to_refine(points, curvature_tolerance, min_spacing)
+        if not indices:
+            break
+
+        for index in indices[: max_points - len(points)]:
+            midpoint = (points[index]["g_squared"] + points[index + 1]["g_squared"]) / 2
+            points.append(
+                continuum_point(
+                    data, round(midpoint, 6), interpolation_order, parameters
+                )
+            )
+        points.sort(key=lambda point: point["g_squared"])
+
+        previous_fixed_point, fixed_point = fixed_point, get_fixed_point(points)
+        if is_stable(previous_fixed_point, fixed_point, tolerance):
+            break
+
+    return points, fixed_point
+
+
+def main():
+    args = get_args()
+    data = read_all_fit_results(args.input_filenames)
+    points, fixed_point = scan(
+        data,
+        args.g_squared_min,
+        args.g_squared_max,
+        initial_points=args.initial_points,
+        max_points=args.max_points,
+        min_spacing=args.min_spacing,
+        curvature_tolerance=args.curvature_tolerance,
+        tolerance=args.tolerance,
+        interpolation_order=args.interpolation_order,
+        resampler=resampling.from_args(args),
+    )
+
+    if args.output_directory:
+        os.makedirs(args.output_directory, exist_ok=True)
+        for point in points:
+            description = {
+                key: value
+                for key, value in point.items()
+                if key not in ("continuum_extrapolation", "samples")
+            }
+            result = point["continuum_extrapolation"]
+            filename = os.path.join(
+                args.output_directory, f"gsquared{point['g_squared']}.json.gz"
+            )
+            pe.input.json.dump_dict_to_json(
+                {
+                    "continuum_extrapolation": rounded(result)
+                    if args.reduced_precision
+                    else result
+                },
+                filename,
+                description=description,
+            )
+            if args.catalog:
+                catalog.register(filename, description)
+    else:
+        for point in points:
+            print(
+                f"continuum beta(g^2 = {point['g_squared']}): "
+                f"{point['continuum_extrapolation']}"
+            )
+
+    print(f"Sampled {len(points)} values of g^2.")
+    if fixed_point is not None:
+        g_star_squared, gamma_star = fixed_point
+        print(f"g_{{GF*}}^2 interpolation: {g_star_squared}")
+        print(f"gamma*: {gamma_star}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+
+import contextlib
+import fcntl
+import os
+import pickle
+import tempfile
+from multiprocessing import resource_tracker, shared_memory
+
+import joblib
+import numpy as np
+
+from linear_corr import FlowSamples, LinearCorr
+from read import get_all_flows
+
+# Where the processes using each set of segments are recorded; this must be
+# common to all jobs on a node, which the temporary directory isn't
+# where a scheduler sets TMPDIR per job
+default_registry_directory = os.path.join(tempfile.gettempdir(), "hp_pv_shared_flows")
+corr_keys = ["t2E", "gGF^2", "betaGF"]
+
+
+def _pack_samples(samples, dtype):
+    deltas = np.concatenate([samples.deltas[name] for name in samples.names], axis=1)
+    return deltas.astype(dtype), {
+        "names": samples.names,
+        "idl": samples.idl,
+        "r_values": samples.r_values,
+    }
+
+
+def _open_segment(name, size=0):
+    segment = shared_memory.SharedMemory(name=name, create=size > 0, size=size)
+    # Lifetime is managed through the registry below rather than by the
+    # resource tracker, which would otherwise unlink the segment when the
+    # first attached process exits
+    resource_tracker.unregister(segment._name, "shared_memory")
+    return segment
+
+
+def _create_segments(key, flows, dtype):
+    # Each ensemble's gGF^2 and betaGF are linear maps over its t2E samples,
+    # so only those deltas are placed in shared memory
+    layout, arrays, offset = [], [], 0
+    for flow in flows:
+        samples = flow["t2E"].samples
+        deltas, samples_layout = _pack_samples(samples, dtype)
+        samples_layout.update(offset=offset, shape=deltas.shape)
+        arrays.append(deltas.ravel())
+        offset += deltas.size
+
+        ensemble_layout = {
+            "metadata": {
+                name: value for name, value in flow.items() if name not in corr_keys
+            },
+            "samples": samples_layout,
+            "corrs": {},
+        }
+        for corr_key in corr_keys:
+            if flow[corr_key].samples is not samples:
+                raise ValueError(f"{corr_key} is not derived from t2E.")
+            ensemble_layout["corrs"][corr_key] = {
+                "weights": flow[corr_key].weights,
+                "present": flow[corr_key].present,
+            }
+        layout.append(ensemble_layout)
+
+    header = pickle.dumps({"dtype": np.dtype(dtype).str, "ensembles": layout})
+    header_segment = _open_segment(f"{key}h", size=len(header))
+    header_segment.buf[: len(header)] = header
+    data_segment = _open_segment(
+        f"{key}d", size=max(offset, 1) * np.dtype(dtype).itemsize
+    )
+    np.ndarray((offset,), dtype=dtype, buffer=data_segment.buf)[:] = np.concatenate(
+        arrays
+    )
+    return header_segment, data_segment
+
+
+def _attach_segments(key):
+    return _open_segment(f"{key}h"), _open_segment(f"{key}d")
+
+
+def _unpack(header_segment, data_segment):
+    header = pickle.loads(header_segment.buf)
+    dtype = np.dtype(header["dtype"])
+    data = np.ndarray(
+        (data_segment.size // dtype.itemsize,), dtype=dtype, buffer=data_segment.buf
+    )
+    data.flags.writeable = False
+
+    flows = []
+    for ensemble_layout in header["ensembles"]:
+        samples_layout = ensemble_layout["samples"]
+        num_rows, num_samples = samples_layout["shape"]
+        start = samples_layout["offset"]
+        deltas = data[start : start + num_rows * num_samples].reshape(
+            num_rows, num_samples
+        )
+        splits = np.cumsum([0] + [len(idl) for idl in samples_layout["idl"]])
+        samples = FlowSamples(
+            {
+                name: deltas[:, begin:end]
+                for name, begin, end in zip(
+                    samples_layout["names"], splits[:-1], splits[1:]
+                )
+            },
+            samples_layout["r_values"],
+            samples_layout["names"],
+            samples_layout["idl"],
+        )
+
+        flow = dict(ensemble_layout["metadata"])
+        for corr_key, corr_layout in ensemble_layout["corrs"].items():
+            flow[corr_key] = LinearCorr(
+                samples, corr_layout["weights"], corr_layout["present"]
+            )
+        flows.append(flow)
+    return flows
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # The process exists, but belongs to another user
+        pass
+    return True
+
+
+def _read_users(lock_file):
+    lock_file.seek(0)
+    return {int(line) for line in lock_file.read().split() if _is_alive(int(line))}
+
+
+def _unlink_segment(segment):
+    # unlink() deregisters from the tracker itself
+    resource_tracker.register(segment._name, "shared_memory")
+    segment.unlink()
+
+
+def _is_current(lock_file, filename):
+    # Whether the locked file is still the one at filename, rather than
+    # one removed by _remove_leaked_segments while waiting for the lock
+    try:
+        return os.stat(filename).st_ino == os.fstat(lock_file.fileno()).st_ino
+    except FileNotFoundError:
+        return False
+
+
+@contextlib.contextmanager
+def _locked_users(key, registry_directory):
+    # Processes currently attached to the segments, serialised by a file lock;
+    # entries for processes that have since died are dropped
+    os.makedirs(registry_directory, exist_ok=True)
+    filename = os.path.join(registry_directory, f"{key}.lock")
+    while True:
+        lock_file = open(filename, "a+")
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        if _is_current(lock_file, filename):
+            break
+        lock_file.close()
+    with lock_file:
+        users = _read_users(lock_file)
+        try:
+            yield users
+        finally:
+            lock_file.seek(0)
+            lock_file.truncate()
+            lock_file.write("".join(f"{pid}\n" for pid in users))
+            lock_file.flush()
+
+
+def _remove_leaked_segments(current_key, registry_directory):
+    # The resource tracker doesn't know about the segments, so those of
+    # processes that died without detaching (for example after a crash)
+    # would stay in /dev/shm until reboot. Remove any that no live process
+    # is using, along with their lock files; locks held by others,
+    # for instance while loading data, are skipped rather than waited for.
+    for filename in os.listdir(registry_directory):
+        key, extension = os.path.splitext(filename)
+        if extension != ".lock" or key == current_key:
+            continue
+        filename = os.path.join(registry_directory, filename)
+        with open(filename, "a+") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+            if not _is_current(lock_file, filename) or _read_users(lock_file):
+                continue
+            for suffix in "hd":
+                with contextlib.suppress(FileNotFoundError):
+                    segment = _open_segment(f"{key}{suffix}")
+                    segment.close()
+                    _unlink_segment(segment)
+            os.unlink(filename)
+
+
+@contextlib.contextmanager
+def shared_all_flows(
+    filenames,
+    reader="hp",
+    operator="sym",
+    extra_metadata=None,
+    bin_size=None,
+    incremental=False,
+    workers=1,
+    reduced_precision=False,
+    registry_directory=None,
+):
+    # As read.get_all_flows, but with the deltas held once per node in shared
+    # memory, which every concurrent caller attaches to read-only.
+    # The first caller loads the data (via the usual joblib cache)
+    # and creates the segments; the last caller to leave unlinks them.
+    # With reduced_precision, the deltas are held in single precision.
+    # The size and modification time of each file are part of the key,
+    # so that segments loaded before a file was changed or appended to
+    # (as with incremental) aren't reused.
+    if registry_directory is None:
+        registry_directory = default_registry_directory
+    key = (
+        "hppv"
+        + joblib.hash(
+            (
+                [
+                    (filename, os.stat(filename).st_size, os.stat(filename).st_mtime_ns)
+                    for filename in filenames
+                ],
+                reader,
+                operator,
+                extra_metadata,
+                bin_size,
+                reduced_precision,
+            )
+        )[:20]
+    )
+
+    with _locked_users(key, registry_directory) as users:
+        _remove_leaked_segments(key, registry_directory)
+        try:
+            segments = _attach_segments(key)
+        except FileNotFoundError:
+            segments = _create_segments(
+                key,
+                get_all_flows(
+                    filenames,
+                    reader=reader,
+                    operator=operator,
+                    extra_metadata=extra_metadata,
+                    bin_size=bin_size,
+                    incremental=incremental,
+                    workers=workers,
+                    reduced_precision=reduced_precision,
+                ),
+                np.float32 if reduced_precision else float,
+            )
+        users.add(os.getpid())
+
+    flows = _unpack(*segments)
+    try:
+        yield flows
+    finally:
+        for flow in flows:
+            flow["t2E"].release()
+        with _locked_users(key, registry_directory) as users:
+            users.discard(os.getpid())
+            for segment in segments:
+                # Obs built from the segments are copies, so once the views
+                # above are released nothing should still export the buffer
+                with contextlib.suppress(BufferError):
+                    segment.close()
+                if not users:
+                    _unlink_segment(segment)
@@ -4,41 +4,6 @@ import argparse
 import itertools
 import logging
 
-import numpy as np
-import pyerrors as pe
-
-
-def _backward_enumerate(iterable):
-    index = len(iterable) - 1
-    for item in iterable:
-        yield index, item
-        index -= 1
-
-
-def get_non_none_indices(iterable):
-    for start_index, element in enumerate(iterable):
-        if element is not None:
-            break
-    else:
-        raise ValueError("dt2E/dt is never not None")
-
-    for end_index, element in _backward_enumerate(iterable):
-        if element is not None:
-            break
-
-    return start_index, end_index + 1
-
-
-def partial_corr_mult(array, partial_corr):
-    start_index, end_index = get_non_none_indices(partial_corr.content)
-    W_middle = (
-        array[start_index:end_index]
-        * np.asarray(partial_corr.content[start_index:end_index]).T
-    ).T
-    return pe.Corr(
-        [None] * start_index + list(W_middle) + [None] * (len(array) - end_index)
-    )
-
 
 def zip_combinations(*lists, min_count=1):
     max_count = min([len(list_) for list_ in lists])
@@ -57,3 +22,11 @@ class SplitArgs(argparse.Action):
             setattr(namespace, self.dest, None)
         else:
             setattr(namespace, self.dest, list(map(float, values.split(","))))
+
+
+def bin_size(value):
+    return value if value == "auto" else int(value)
+
+
+def interpolation_order(value):
+    return value if value == "average" else int(value)
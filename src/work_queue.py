@@ -0,0 +1,524 @@
+#!/usr/bin/env python3
+
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import time
+
+from pipeline import load_config
+from plan_workflow import get_jobs, job_outputs
+from read import grown_inputs
+
+# The per-job entry points, and the options naming their output,
+# for the analysis rules of workflow/Snakefile
+scripts = {
+    "extrapolate_infinite_volume": ("src/extrapolate_infinite_volume.py", None),
+    "extrapolate_infinite_volume_global": (
+        "src/extrapolate_infinite_volume.py",
+        None,
+    ),
+    "interpolate_finite_a": ("src/fit_beta_against_g2.py", None),
+    "extrapolate_continuum": ("src/extrapolate_continuum.py", None),
+    "scan_continuum": ("src/scan_continuum.py", "--output_directory"),
+    "fit_fixed_point": ("src/fit_fixed_point.py", None),
+}
+states = ["pending", "claimed", "done", "failed"]
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description=(
+            "Run the analysis stages of workflow/Snakefile as a work queue "
+            "held in a directory on a shared filesystem. "
+            "Submit the tasks once, then start workers on as many nodes as wanted."
+        )
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    submit_parser = subparsers.add_parser("submit", help="Add tasks to the queue")
+    submit_parser.add_argument("queue_directory")
+    submit_parser.add_argument("--config_file", default="workflow/config.yaml")
+    submit_parser.add_argument(
+        "--config",
+        nargs="+",
+        default=[],
+        metavar="KEY=VALUE",
+        help="Override configuration values, as for snakemake --config",
+    )
+    submit_parser.add_argument("--max_attempts", type=int, default=3)
+    submit_parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Also submit tasks whose outputs already exist",
+    )
+
+    work_parser = subparsers.add_parser("work", help="Run tasks until none remain")
+    work_parser.add_argument("queue_directory")
+    work_parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of worker processes to run on this node",
+    )
+    work_parser.add_argument(
+        "--lease",
+        type=float,
+        default=600,
+        help=(
+            "Seconds after which a claimed task whose worker has stopped "
+            "reporting progress is handed to another worker"
+        ),
+    )
+    work_parser.add_argument("--poll_interval", type=float, default=5)
+
+    status_parser = subparsers.add_parser("status", help="Count tasks in each state")
+    status_parser.add_argument("queue_directory")
+    return parser.parse_args()
+
+
+def get_arguments(job, config):
+    # The options that the Snakefile passes, other than inputs and output
+    wildcards = job.wildcards
+    reduced_precision = (
+        ["--reduced_precision"] if config.get("reduced_precision", False) else []
+    )
+    resampling = (
+        [
+            "--resampling",
+            config["resampling"],
+            "--bootstrap_samples",
+            str(config["bootstrap_samples"]),
+            "--seed",
+            str(config["resampling_seed"]),
+        ]
+        if config.get("resampling")
+        else []
+    )
+    ingestion = [
+        "--workers",
+        str(config.get("ingest_workers", 1)),
+        *(["--bin_size", str(config["bin_size"])] if "bin_size" in config else []),
+        *(["--shared_memory"] if config.get("shared_memory", False) else []),
+        *(
+            ["--shared_memory_directory", str(config["shared_memory_directory"])]
+            if config.get("shared_memory", False)
+            and "shared_memory_directory" in config
+            else []
+        ),
+        *(["--incremental"] if config.get("incremental", False) else []),
+        *reduced_precision,
+    ]
+    if job.rule == "extrapolate_infinite_volume":
+        return [
+            "--operator",
+            wildcards["operator"],
+            "--time",
+            wildcards["time"],
+            *ingestion,
+            *resampling,
+        ]
+    if job.rule == "extrapolate_infinite_volume_global":
+        return [
+            "--operator",
+            wildcards["operator"],
+            "--time",
+            *wildcards["times"],
+            *ingestion,
+            "--global_fit_times",
+            str(config["global_fit_times"]["tmin"]),
+            str(config["global_fit_times"]["tmax"]),
+            "--global_fit_degree",
+            str(config["global_fit_degree"]),
+            *resampling,
+        ]
+    interpolation_order = (
+        ["--interpolation_order", str(config["continuum_interpolation_order"])]
+        if config["continuum_interpolation_order"] is not None
+        else []
+    )
+    if job.rule == "interpolate_finite_a":
+        return [
+            "--order",
+            str(config["interpolate_fit_order"]),
+            *(
+                ["--orders", *map(str, config["interpolate_fit_orders"])]
+                if config["interpolate_fit_orders"]
+                else []
+            ),
+            *(["--average"] if config["interpolate_fit_average"] else []),
+            *reduced_precision,
+        ]
+    if job.rule == "extrapolate_continuum":
+        return [
+            "--g_squared",
+            wildcards["g_squared"],
+            *interpolation_order,
+            *reduced_precision,
+            *resampling,
+        ]
+    if job.rule == "scan_continuum":
+        return [
+            "--g_squared_min",
+            str(wildcards["g_squared_min"]),
+            "--g_squared_max",
+            str(wildcards["g_squared_max"]),
+            *interpolation_order,
+            *reduced_precision,
+            *resampling,
+        ]
+    if job.rule == "fit_fixed_point":
+        return resampling
+    return []
+
+
+def task_name(job):
+    return f"{job.rule}-{os.path.basename(job.output)}.task"
+
+
+def _path(queue_directory, state, name):
+    return os.path.join(queue_directory, state, name)
+
+
+def _worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def _write_atomic(filename, task):
+    # Writers use a hidden temporary name in the same directory,
+    # which listings ignore, then rename it into place
+    temporary_filename = os.path.join(
+        os.path.dirname(filename), f".{os.path.basename(filename)}.{_worker_id()}"
+    )
+    with open(temporary_filename, "w") as f:
+        json.dump(task, f)
+    os.replace(temporary_filename, filename)
+
+
+def _read(filename):
+    with open(filename) as f:
+        return json.load(f)
+
+
+def _list(queue_directory, state):
+    return [
+        name
+        for name in os.listdir(os.path.join(queue_directory, state))
+        if not name.startswith(".")
+    ]
+
+
+def submit(queue_directory, config, max_attempts=3, force=False):
+    for state in states + ["logs"]:
+        os.makedirs(os.path.join(queue_directory, state), exist_ok=True)
+
+    existing = {name for state in states for name in _list(queue_directory, state)}
+    submitted = 0
+    # Outputs to be redone as data files have grown since they were ingested,
+    # and so everything computed from them; jobs come in dependency order
+    stale = set()
+    for job in get_jobs(config):
+        if job.rule not in scripts:
+            continue
+        name = task_name(job)
+        outputs = job_outputs(job)
+        if any(filename in stale for filename in job.inputs) or (
+            config.get("incremental", False)
+            and job.rule.startswith("extrapolate_infinite_volume")
+            and grown_inputs(job.inputs, operator=job.wildcards["operator"])
+        ):
+            stale.update(outputs)
+        elif not force and (
+            name in existing or all(os.path.exists(output) for output in outputs)
+        ):
+            continue
+        script, output_option = scripts[job.rule]
+        for state in states:
+            if state != "pending" and os.path.exists(
+                _path(queue_directory, state, name)
+            ):
+                os.remove(_path(queue_directory, state, name))
+        _write_atomic(
+            _path(queue_directory, "pending", name),
+            {
+                "rule": job.rule,
+                "script": script,
+                "inputs": job.inputs,
+                "arguments": get_arguments(job, config),
+                "outputs": outputs,
+                "output_option": output_option or "--output_filename",
+                "directory": os.getcwd(),
+                "attempts": 0,
+                "max_attempts": max_attempts,
+            },
+        )
+        submitted += 1
+    return submitted
+
+
+class Worker:
+    def __init__(self, queue_directory, lease=600, poll_interval=5):
+        self.queue_directory = queue_directory
+        self.lease = lease
+        self.poll_interval = poll_interval
+        # Task definitions don't change other than their attempt counts,
+        # so are read only once
+        self._tasks = {}
+        # Tasks that looked impossible to run on the last step
+        self._blocked = set()
+
+    def _task(self, state, name):
+        if name not in self._tasks:
+            self._tasks[name] = _read(_path(self.queue_directory, state, name))
+        return self._tasks[name]
+
+    def _outputs(self, state):
+        outputs = set()
+        for name in _list(self.queue_directory, state):
+            try:
+                outputs.update(self._task(state, name)["outputs"])
+            except FileNotFoundError:
+                # Moved on by another worker since being listed
+                pass
+        return outputs
+
+    def _give_up_or_retry(self, name, claimed_filename, reason, retry=True):
+        # Called for a task that this worker holds as claimed_filename
+        task = _read(claimed_filename)
+        task["attempts"] += 1
+        task.setdefault("errors", []).append(f"{_worker_id()}: {reason}")
+        if retry and task["attempts"] < task["max_attempts"]:
+            _write_atomic(_path(self.queue_directory, "pending", name), task)
+        else:
+            _write_atomic(_path(self.queue_directory, "failed", name), task)
+        try:
+            os.remove(claimed_filename)
+        except FileNotFoundError:
+            pass
+
+    def reclaim_stale(self):
+        # Tasks whose worker has stopped touching them are assumed to have died
+        for name in _list(self.queue_directory, "claimed"):
+            filename = _path(self.queue_directory, "claimed", name)
+            # Take ownership under a hidden name, so only one worker reclaims it
+            stale_filename = _path(
+                self.queue_directory, "claimed", f".{name}.{_worker_id()}"
+            )
+            try:
+                if time.time() - os.path.getmtime(filename) < self.lease:
+                    continue
+                os.rename(filename, stale_filename)
+            except FileNotFoundError:
+                continue
+            self._give_up_or_retry(name, stale_filename, "lease expired")
+
+    def claim(self, name):
+        # The modification time is the heartbeat, and is kept by the rename;
+        # refresh it first so that the claimed task doesn't look stale
+        try:
+            os.utime(_path(self.queue_directory, "pending", name))
+            os.rename(
+                _path(self.queue_directory, "pending", name),
+                _path(self.queue_directory, "claimed", name),
+            )
+        except FileNotFoundError:
+            return None
+        return _read(_path(self.queue_directory, "claimed", name))
+
+    def run(self, name, task):
+        claimed_filename = _path(self.queue_directory, "claimed", name)
+        directory = task["directory"]
+        outputs = [os.path.join(directory, output) for output in task["outputs"]]
+        # Each is written under a hidden name beside the output,
+        # then renamed into place, so that it appears complete or not at all
+        temporary_outputs = []
+        for output in outputs:
+            os.makedirs(os.path.dirname(output), exist_ok=True)
+            temporary_outputs.append(
+                os.path.join(
+                    os.path.dirname(output),
+                    f".{_worker_id()}.{os.path.basename(output)}",
+                )
+            )
+
+        inputs = []
+        for filename in task["inputs"]:
+            if os.path.isdir(os.path.join(directory, filename)):
+                # As the Snakefile does for the outputs of scan_continuum
+                inputs.extend(
+                    sorted(
+                        os.path.relpath(match, directory)
+                        for match in glob.glob(
+                            os.path.join(directory, filename, "*.json.gz")
+                        )
+                    )
+                )
+            else:
+                inputs.append(filename)
+
+        log_filename = os.path.join(
+            self.queue_directory, "logs", f"{name}.{task['attempts']}.log"
+        )
+        with open(log_filename, "w") as log:
+            process = subprocess.Popen(
+                [
+                    sys.executable,
+                    task["script"],
+                    *inputs,
+                    *task["arguments"],
+                    task["output_option"],
+                    *temporary_outputs,
+                ],
+                cwd=directory,
+                stdout=log,
+                stderr=subprocess.STDOUT,
+            )
+            while True:
+                try:
+                    returncode = process.wait(timeout=self.lease / 4)
+                    break
+                except subprocess.TimeoutExpired:
+                    try:
+                        os.utime(claimed_filename)
+                    except FileNotFoundError:
+                        # Reclaimed by another worker; the output is committed
+                        # atomically so it doesn't matter who finishes first
+                        pass
+
+        if returncode != 0 or not all(map(os.path.exists, temporary_outputs)):
+            for temporary_output in temporary_outputs:
+                if os.path.isdir(temporary_output):
+                    shutil.rmtree(temporary_output)
+                elif os.path.exists(temporary_output):
+                    os.remove(temporary_output)
+            self._give_up_or_retry(
+                name,
+                claimed_filename,
+                f"exited with status {returncode}; see {log_filename}",
+            )
+            return
+
+        for output, temporary_output in zip(outputs, temporary_outputs):
+            if os.path.isdir(output):
+                # Directory outputs can't be replaced atomically;
+                # the new one is moved in as soon as the old one is gone
+                shutil.rmtree(output)
+            os.replace(temporary_output, output)
+        try:
+            os.rename(claimed_filename, _path(self.queue_directory, "done", name))
+        except FileNotFoundError:
+            pass
+
+    def step(self):
+        # Run one task if any is ready; returns False once the queue is empty
+        self.reclaim_stale()
+        pending = _list(self.queue_directory, "pending")
+        if not pending and not _list(self.queue_directory, "claimed"):
+            return False
+
+        # Pending is listed first, since tasks move from there to claimed
+        unfinished = self._outputs("pending") | self._outputs("claimed")
+        failed = self._outputs("failed")
+        blocked, self._blocked = self._blocked, set()
+        random.shuffle(pending)
+        for name in pending:
+            try:
+                task = self._task("pending", name)
+            except FileNotFoundError:
+                continue
+            if any(filename in unfinished for filename in task["inputs"]):
+                continue
+            missing = [
+                filename
+                for filename in task["inputs"]
+                if not os.path.exists(os.path.join(task["directory"], filename))
+            ]
+            if missing or any(filename in failed for filename in task["inputs"]):
+                # No task will produce these inputs, so this can never run.
+                # Listings are not atomic, so wait to see the same twice
+                if name not in blocked:
+                    self._blocked.add(name)
+                elif self.claim(name) is not None:
+                    self._give_up_or_retry(
+                        name,
+                        _path(self.queue_directory, "claimed", name),
+                        "inputs failed or missing: "
+                        + ", ".join(
+                            filename
+                            for filename in task["inputs"]
+                            if filename in failed or filename in missing
+                        ),
+                        retry=False,
+                    )
+                continue
+            task = self.claim(name)
+            if task is not None:
+                self.run(name, task)
+                return True
+
+        time.sleep(self.poll_interval)
+        return True
+
+    def work(self):
+        while self.step():
+            pass
+
+
+def _work(queue_directory, lease, poll_interval):
+    Worker(queue_directory, lease=lease, poll_interval=poll_interval).work()
+
+
+def work(queue_directory, workers=1, lease=600, poll_interval=5):
+    # Each process behaves as an independent node would
+    processes = [
+        multiprocessing.Process(
+            target=_work, args=(queue_directory, lease, poll_interval)
+        )
+        for _ in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+
+def status(queue_directory):
+    return {state: len(_list(queue_directory, state)) for state in states}
+
+
+def main():
+    args = get_args()
+    if args.command == "submit":
+        config = load_config(args.config_file, args.config)
+        submitted = submit(
+            args.queue_directory,
+            config,
+            max_attempts=args.max_attempts,
+            force=args.force,
+        )
+        print(f"Submitted {submitted} tasks.")
+    elif args.command == "work":
+        work(
+            args.queue_directory,
+            workers=args.workers,
+            lease=args.lease,
+            poll_interval=args.poll_interval,
+        )
+
+    counts = status(args.queue_directory)
+    print(", ".join(f"{count} {state}" for state, count in counts.items()))
+    for name in _list(args.queue_directory, "failed"):
+        task = _read(_path(args.queue_directory, "failed", name))
+        print(f"failed: {task['outputs'][0]}: {task.get('errors', [])[-1]}")
+    if counts["failed"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()